@@ -0,0 +1,393 @@
+"""
+Benchmark della generazione PDF.
+
+Genera ZIP sintetici di immagini e misura il tempo per pagina e la
+dimensione del PDF prodotto da create_pdf_from_images.
+Con "links" confronta, al crescere del numero di link, l'aggiunta degli
+screenshot con add_screenshot_to_pdf (un merge per link) e la scrittura in
+un solo passaggio, misurando tempo e picco di memoria.
+Con "suite" esegue una serie di scenari (numero, dimensione e formato delle
+immagini), ognuno in un processo separato, e salva in JSON tempi per fase,
+pagine/s, picco di RSS e dimensione del PDF.
+Con "load" avvia l'app con uvicorn e il provider di screenshot "stub" e
+invia richieste concorrenti a /genera_pdf.
+Con "compare" confronta due file JSON prodotti da suite o load.
+Con "profiles" genera lo stesso ZIP con ogni profilo di uscita e confronta
+tempo e dimensione del PDF.
+
+Uso: python benchmark.py [numero_immagini] [ripetizioni]
+     python benchmark.py links [numero_immagini]
+     python benchmark.py suite [file.json]
+     python benchmark.py load [richieste] [concorrenza] [file.json]
+     python benchmark.py compare prima.json dopo.json
+     python benchmark.py profiles [numero_immagini]
+"""
+import io
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+
+from PIL import Image
+
+import main
+
+# Formati delle immagini sintetiche: "mixed" alterna tutti gli altri
+IMAGE_KINDS = ("jpeg", "png", "rgba", "palette", "noext")
+
+# (nome, formato, numero immagini, dimensione in pixel, numero link)
+SUITE_SCENARIOS = [
+    ("jpeg_10_small", "jpeg", 10, (800, 600), 0),
+    ("jpeg_50_medium", "jpeg", 50, (1600, 1200), 0),
+    ("jpeg_20_large", "jpeg", 20, (4000, 3000), 0),
+    ("png_20_medium", "png", 20, (1600, 1200), 0),
+    ("rgba_20_medium", "rgba", 20, (1600, 1200), 0),
+    ("palette_20_medium", "palette", 20, (1600, 1200), 0),
+    ("noext_20_medium", "noext", 20, (1600, 1200), 0),
+    ("mixed_50_medium", "mixed", 50, (1600, 1200), 0),
+    ("jpeg_20_medium_5_links", "jpeg", 20, (1600, 1200), 5),
+]
+
+RESULTS_DIR = "benchmark_results"
+
+
+def make_image(kind: str, size, index: int):
+    """
+    Immagine sintetica con rumore e gradienti, diversa per ogni indice, e
+    relativo nome nello ZIP. Restituisce (nome, bytes).
+    """
+    if kind == "mixed":
+        kind = IMAGE_KINDS[index % len(IMAGE_KINDS)]
+    noise = Image.effect_noise(size, 30 + index % 20)
+    gradient = Image.linear_gradient('L').resize(size)
+    radial = Image.radial_gradient('L').resize(size)
+    img = Image.merge('RGB', (noise, gradient, radial))
+    buffer = io.BytesIO()
+    if kind == "jpeg":
+        img.save(buffer, format='JPEG', quality=90)
+        name = f"foto_{index:04d}.jpg"
+    elif kind == "png":
+        img.save(buffer, format='PNG')
+        name = f"foto_{index:04d}.png"
+    elif kind == "rgba":
+        img.putalpha(radial)
+        img.save(buffer, format='PNG')
+        name = f"foto_{index:04d}.png"
+    elif kind == "palette":
+        img.convert('P', palette=Image.ADAPTIVE, colors=64).save(buffer, format='PNG')
+        name = f"foto_{index:04d}.png"
+    elif kind == "noext":
+        # Alterna JPEG e PNG senza estensione (riconosciuti dal magic number)
+        img.save(buffer, format='JPEG' if index % 2 == 0 else 'PNG')
+        name = f"foto_{index:04d}"
+    else:
+        raise ValueError(f"Formato sconosciuto: {kind}")
+    return name, buffer.getvalue()
+
+
+def make_zip(image_count: int, size=(1600, 1200), kind: str = "jpeg") -> bytes:
+    """Crea uno ZIP con image_count immagini sintetiche del formato indicato."""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zip_ref:
+        for i in range(image_count):
+            name, data = make_image(kind, size, i)
+            zip_ref.writestr(name, data)
+    return buffer.getvalue()
+
+
+def run(image_count: int = 50, repeats: int = 3):
+    zip_bytes = make_zip(image_count)
+    main.logo_cache.get()
+
+    timings = []
+    pdf_size = 0
+    for _ in range(repeats):
+        start = time.perf_counter()
+        pdf_size = len(main.create_pdf_from_images(zip_bytes))
+        timings.append(time.perf_counter() - start)
+
+    best = min(timings)
+    print(f"Immagini: {image_count}, ripetizioni: {repeats}")
+    print(f"Tempo migliore: {best:.3f} s ({best / image_count * 1000:.1f} ms/pagina)")
+    print(f"Dimensione PDF: {pdf_size} bytes ({pdf_size / image_count:.0f} bytes/pagina)")
+
+
+def make_screenshots(count: int) -> list:
+    """Screenshot sintetici 960x1300 (PNG), uno diverso per ogni link."""
+    screenshots = []
+    for i in range(count):
+        img = Image.new('RGB', (960, 1300), (200, (i * 53) % 256, (i * 29) % 256))
+        img_buffer = io.BytesIO()
+        img.save(img_buffer, format='PNG')
+        screenshots.append((f"https://esempio{i}.it/prodotto", img_buffer.getvalue()))
+    return screenshots
+
+
+def measure(func):
+    """Esegue func e restituisce (secondi, picco di memoria Python in MB)."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak / (1024 * 1024)
+
+
+def run_links(image_count: int = 20, link_counts=(1, 5, 10, 20)):
+    zip_bytes = make_zip(image_count)
+    main.logo_cache.get()
+
+    def merge_per_link(screenshots):
+        pdf_bytes = main.create_pdf_from_images(zip_bytes)
+        for link, screenshot_bytes in screenshots:
+            pdf_bytes = main.add_screenshot_to_pdf(pdf_bytes, link, screenshot_bytes)
+
+    def single_pass(screenshots):
+        main.create_pdf_from_images(zip_bytes, screenshots=screenshots)
+
+    results = []
+    for link_count in link_counts:
+        screenshots = make_screenshots(link_count)
+        merge_time, merge_peak = measure(lambda: merge_per_link(screenshots))
+        single_time, single_peak = measure(lambda: single_pass(screenshots))
+        results.append((link_count, merge_time, merge_peak, single_time, single_peak))
+
+    print(f"Immagini: {image_count}")
+    print(f"{'link':>5} {'merge s':>9} {'merge MB':>9} {'singolo s':>10} {'singolo MB':>11}")
+    for link_count, merge_time, merge_peak, single_time, single_peak in results:
+        print(f"{link_count:>5} {merge_time:>9.3f} {merge_peak:>9.1f} {single_time:>10.3f} {single_peak:>11.1f}")
+
+
+def peak_rss_mb() -> float:
+    """Picco di RSS del processo e dei figli gia' terminati, in MB (ru_maxrss e' in KB su Linux)."""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024
+
+
+def run_scenario(name: str, kind: str, image_count: int, size, link_count: int, repeats: int = 3) -> dict:
+    """
+    Esegue uno scenario in questo processo (va lanciato in un processo nuovo,
+    cosi' il picco di RSS non dipende dagli scenari precedenti).
+    Con link, gli screenshot sintetici vengono aggiunti sia in un solo passaggio
+    sia con add_screenshot_to_pdf, per confronto.
+    """
+    # I messaggi della pipeline non servono qui: si stampa solo il riepilogo
+    main.logger.setLevel(logging.WARNING)
+    zip_bytes = make_zip(image_count, tuple(size), kind)
+    screenshots = make_screenshots(link_count)
+    main.logo_cache.get()
+
+    best = None
+    for _ in range(repeats):
+        stats = {}
+        start = time.perf_counter()
+        main.create_pdf_from_images(zip_bytes, stats=stats, screenshots=screenshots)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best[0]:
+            best = (elapsed, stats)
+
+    merge_seconds = None
+    if link_count:
+        start = time.perf_counter()
+        pdf_bytes = main.create_pdf_from_images(zip_bytes)
+        for link, screenshot_bytes in screenshots:
+            pdf_bytes = main.add_screenshot_to_pdf(pdf_bytes, link, screenshot_bytes)
+        merge_seconds = round(time.perf_counter() - start, 4)
+    main.shutdown_image_executor()
+
+    elapsed, stats = best
+    pages = 1 + image_count + stats["screenshot_pages"]
+    result = {
+        "name": name,
+        "kind": kind,
+        "images": image_count,
+        "size": list(size),
+        "links": link_count,
+        "zip_bytes": len(zip_bytes),
+        "seconds": round(elapsed, 4),
+        "pages": pages,
+        "pages_per_sec": round(pages / elapsed, 2),
+        "output_bytes": stats["output_bytes"],
+        "timings": {stage: round(value, 4) for stage, value in stats["timings"].items()},
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+    if merge_seconds is not None:
+        result["merge_per_link_seconds"] = merge_seconds
+    return result
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "sconosciuta"
+
+
+def default_output(prefix: str) -> str:
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return os.path.join(RESULTS_DIR, f"{prefix}_{stamp}_{git_revision()}.json")
+
+
+def save_results(path: str, kind: str, results: list, **extra):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"type": kind, "revision": git_revision(), "date": datetime.now().isoformat(timespec="seconds"),
+                   "cpu_count": os.cpu_count(), **extra, "results": results}, f, indent=2)
+    print(f"\nRisultati salvati in {path}")
+
+
+def run_suite(output_path: str = ""):
+    """Esegue SUITE_SCENARIOS, ognuno in un processo nuovo, e salva i risultati in JSON."""
+    results = []
+    print(f"{'scenario':<26} {'s':>8} {'pag/s':>8} {'RSS MB':>8} {'PDF bytes':>11}  fasi (s)")
+    for scenario in SUITE_SCENARIOS:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            result = executor.submit(run_scenario, *scenario).result()
+        results.append(result)
+        stages = " ".join(f"{stage}={value:.3f}" for stage, value in result["timings"].items() if stage != "total")
+        print(f"{result['name']:<26} {result['seconds']:>8.3f} {result['pages_per_sec']:>8.1f} "
+              f"{result['peak_rss_mb']:>8.1f} {result['output_bytes']:>11}  {stages}")
+    save_results(output_path or default_output("suite"), "suite", results)
+
+
+def run_load(request_count: int = 40, concurrency: int = 8, output_path: str = "",
+             image_count: int = 10, link_count: int = 2, port: int = 8765):
+    """
+    Avvia l'app con uvicorn (screenshot "stub", logo locale) e invia request_count
+    richieste a /genera_pdf con concurrency client in parallelo.
+    Le richieste sono tutte uguali: la cache dei PDF e il limite sugli ZIP grandi
+    sono disattivati, altrimenti si misurerebbero risposte dalla cache o 503.
+    """
+    env = dict(os.environ, SCREENSHOT_PROVIDER="stub", LOGO_URL="", SCREENSHOT_CACHE_TTL="0", LOG_LEVEL="WARNING",
+               PDF_OUTPUT_CACHE_MAX_BYTES="0", PDF_MAX_LARGE_RENDERS="0")
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port),
+                               "--log-level", "warning"], env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        for _ in range(100):
+            try:
+                if main.requests.get(f"{base_url}/health", timeout=1).ok:
+                    break
+            except main.requests.RequestException:
+                time.sleep(0.2)
+        else:
+            raise RuntimeError("Il server non risponde su /health")
+
+        zip_bytes = make_zip(image_count)
+        links = ",".join(f"https://esempio{i}.it/prodotto" for i in range(link_count))
+
+        def send(i: int):
+            start = time.perf_counter()
+            response = main.requests.post(f"{base_url}/genera_pdf", data=zip_bytes,
+                                          headers={"content-type": "application/zip", "link": links},
+                                          timeout=300)
+            return time.perf_counter() - start, response.status_code, len(response.content)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            responses = list(executor.map(send, range(request_count)))
+        elapsed = time.perf_counter() - start
+        server_stats = main.requests.get(f"{base_url}/stats", timeout=5).json()
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies = sorted(latency for latency, _, _ in responses)
+    errors = sum(1 for _, status, _ in responses if status != 200)
+
+    def percentile(p: float) -> float:
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))], 4)
+
+    result = {
+        "name": f"load_{request_count}x{concurrency}",
+        "requests": request_count,
+        "concurrency": concurrency,
+        "images": image_count,
+        "links": link_count,
+        "seconds": round(elapsed, 4),
+        "requests_per_sec": round(request_count / elapsed, 2),
+        "latency_p50": percentile(0.5),
+        "latency_p95": percentile(0.95),
+        "latency_max": round(latencies[-1], 4),
+        "errors": errors,
+        "output_bytes": responses[0][2],
+        "server_max_queued": server_stats.get("max_queued"),
+        "output_cache_hits": server_stats.get("output_cache", {}).get("hits", 0),
+    }
+    for key, value in result.items():
+        print(f"{key:<18} {value}")
+    save_results(output_path or default_output("load"), "load", [result])
+
+
+# Metriche confrontate da compare: piu' basso e' meglio, tranne quelle in HIGHER_IS_BETTER
+COMPARED_METRICS = ("seconds", "pages_per_sec", "requests_per_sec", "latency_p95", "peak_rss_mb", "output_bytes")
+HIGHER_IS_BETTER = ("pages_per_sec", "requests_per_sec")
+
+
+def run_profiles(image_count: int = 20):
+    """Stesso ZIP misto con ogni profilo di OUTPUT_PROFILES: tempo, dimensione e risparmio."""
+    main.logger.setLevel(logging.WARNING)
+    zip_bytes = make_zip(image_count, (2400, 1800), "mixed")
+    main.logo_cache.get()
+    print(f"ZIP: {image_count} immagini miste, {len(zip_bytes)} bytes")
+    print(f"{'profilo':<10} {'DPI':>5} {'s':>8} {'PDF bytes':>11} {'immagini':>11} {'risparmio':>10}")
+    for name, profile in main.OUTPUT_PROFILES.items():
+        stats = {}
+        options = main.RenderOptions(profile=name, target_dpi=profile.target_dpi)
+        start = time.perf_counter()
+        main.create_pdf_from_images(zip_bytes, options, stats)
+        elapsed = time.perf_counter() - start
+        savings = main.size_savings(stats["images_input_bytes"], stats["images_output_bytes"])
+        print(f"{name:<10} {profile.target_dpi:>5} {elapsed:>8.3f} {stats['output_bytes']:>11} "
+              f"{stats['images_output_bytes']:>11} {savings:>10}")
+    main.shutdown_image_executor()
+
+
+def compare(before_path: str, after_path: str):
+    """Confronta due file di risultati scenario per scenario (variazione percentuale)."""
+    with open(before_path) as f:
+        before = {result["name"]: result for result in json.load(f)["results"]}
+    with open(after_path) as f:
+        after_data = json.load(f)
+    print(f"{'scenario':<26} {'metrica':<18} {'prima':>12} {'dopo':>12} {'diff':>8}")
+    for result in after_data["results"]:
+        previous = before.get(result["name"])
+        if previous is None:
+            continue
+        for metric in COMPARED_METRICS:
+            if metric not in result or not previous.get(metric):
+                continue
+            change = (result[metric] - previous[metric]) / previous[metric] * 100
+            worse = change < 0 if metric in HIGHER_IS_BETTER else change > 0
+            flag = " !" if worse and abs(change) >= 10 else ""
+            print(f"{result['name']:<26} {metric:<18} {previous[metric]:>12} {result[metric]:>12} {change:>7.1f}%{flag}")
+
+
+if __name__ == "__main__":
+    command = sys.argv[1:2]
+    if command == ["links"]:
+        run_links(*[int(a) for a in sys.argv[2:3]])
+    elif command == ["suite"]:
+        run_suite(*sys.argv[2:3])
+    elif command == ["load"]:
+        numbers = [int(a) for a in sys.argv[2:4]]
+        run_load(*numbers, *sys.argv[4:5])
+    elif command == ["compare"]:
+        compare(*sys.argv[2:4])
+    elif command == ["profiles"]:
+        run_profiles(*[int(a) for a in sys.argv[2:3]])
+    else:
+        args = [int(a) for a in sys.argv[1:3]]
+        run(*args)
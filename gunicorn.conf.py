@@ -0,0 +1,47 @@
+"""
+Configurazione di gunicorn per la produzione: piu' worker uvicorn, riciclo dei
+worker dopo un numero di richieste o oltre una soglia di memoria residente,
+spegnimento ordinato che completa i PDF in lavorazione.
+
+Uso: gunicorn -c gunicorn.conf.py main:app
+     python main.py --production   (equivalente)
+
+Tutti i valori si possono cambiare con le variabili d'ambiente indicate.
+"""
+import os
+import shutil
+import tempfile
+
+bind = os.getenv("BIND", "0.0.0.0:" + os.getenv("PORT", "8000"))
+worker_class = "uvicorn.workers.UvicornWorker"
+# Un worker per core: il rendering e' soprattutto CPU
+workers = int(os.getenv("PDF_SERVER_WORKERS", str(os.cpu_count() or 1)))
+
+# Riciclo dopo PDF_WORKER_MAX_REQUESTS richieste (con uno scarto casuale, per non
+# riavviare tutti i worker insieme): la memoria frammentata dalle immagini torna al sistema
+max_requests = int(os.getenv("PDF_WORKER_MAX_REQUESTS", "500"))
+max_requests_jitter = int(os.getenv("PDF_WORKER_MAX_REQUESTS_JITTER", str(max_requests // 10)))
+# Riciclo oltre questa memoria residente, controllata da main.py dopo ogni rendering
+os.environ.setdefault("PDF_WORKER_MAX_RSS_MB", "1024")
+
+# Allo spegnimento (o al riciclo) i worker smettono di accettare richieste e completano
+# quelle in corso; dopo graceful_timeout secondi vengono terminati comunque
+graceful_timeout = int(os.getenv("PDF_GRACEFUL_TIMEOUT", "120"))
+timeout = int(os.getenv("PDF_WORKER_TIMEOUT", "120"))
+keepalive = 5
+
+# Ogni worker ha il proprio pool per le immagini: i core vengono divisi tra i worker
+os.environ.setdefault("PDF_IMAGE_WORKERS", str(max(1, (os.cpu_count() or 1) // workers)))
+
+# Metriche Prometheus aggregate tra i worker (vedi /metrics)
+metrics_dir = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR",
+                                    os.path.join(tempfile.gettempdir(), "dpsonline_metrics"))
+
+loglevel = os.getenv("LOG_LEVEL", "info").lower()
+accesslog = "-"
+
+
+def on_starting(server):
+    # I file delle metriche di un avvio precedente falserebbero i contatori
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
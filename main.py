@@ -1,401 +1,1394 @@
-from fastapi import FastAPI, Request, File, UploadFile, Form, Response, Header
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, Request, Response, Header
+from fastapi.responses import StreamingResponse, FileResponse
+from fastapi.concurrency import run_in_threadpool
+from starlette.background import BackgroundTask
+from starlette.datastructures import UploadFile as StarletteUploadFile
 from pydantic import BaseModel
-from typing import Any, Dict, Optional, List
+from typing import Any, BinaryIO, Callable, Dict, Optional, List, Iterable, Tuple, Union
 import json
+import logging
+import asyncio
+import functools
 import uvicorn
 import zipfile
 import io
 import base64
-from datetime import datetime
-from PIL import Image
+from datetime import datetime, date
+from PIL import Image, ImageChops, ImageOps
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4
-from reportlab.lib.utils import ImageReader
+from reportlab.pdfbase import pdfdoc
+from reportlab.pdfbase.pdfmetrics import stringWidth
 import tempfile
 import os
+import shutil
+import uuid
+import fnmatch
+import time
+import hashlib
+import threading
+import zlib
+import math
+import multiprocessing
+from collections import deque, Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import random
+import re
+import resource
+from abc import ABC, abstractmethod
+import signal
+import sys
 import requests
+from urllib3.util.retry import Retry
 from PyPDF2 import PdfReader, PdfWriter
+from prometheus_client import Histogram, Counter as MetricCounter, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess
 from urllib.parse import unquote, urlparse # <-- MODIFICA: Aggiunto urlparse
 
 app = FastAPI(title="PDF Generator API", version="1.1.0")
 
+# Livello dei log da LOG_LEVEL: con DEBUG anche il dettaglio per immagine e gli header
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s [%(threadName)s] %(message)s")
+logger = logging.getLogger("genera_pdf")
+# Header mai scritti nei log
+REDACTED_HEADERS = ("authorization", "cookie", "x-api-key")
+
+# Metriche Prometheus esposte su /metrics
+STAGE_SECONDS = Histogram(
+    "pdf_stage_seconds", "Durata delle fasi di generazione del PDF", ["stage"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+REQUEST_SECONDS = Histogram(
+    "pdf_request_seconds", "Durata complessiva della generazione, per endpoint", ["endpoint"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600))
+PAGES = MetricCounter("pdf_pages", "Pagine generate, per tipo", ["type"])
+INPUT_BYTES = MetricCounter("pdf_input_bytes", "Bytes degli ZIP elaborati")
+OUTPUT_BYTES = MetricCounter("pdf_output_bytes", "Bytes dei PDF generati")
+FAILURES = MetricCounter("pdf_failures", "Errori, per tipo", ["kind"])
+
 # Modello Pydantic opzionale per validare i dati in input
 class PDFRequest(BaseModel):
     titolo: Optional[str] = None
     contenuto: Optional[str] = None
     parametri: Optional[Dict[str, Any]] = None
 
-def download_logo() -> Optional[bytes]:
+# Sessione HTTP condivisa: riusa le connessioni verso logo e servizio di screenshot
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))
+http_session = requests.Session()
+http_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE))
+http_session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE))
+
+LOGO_URL = os.getenv("LOGO_URL", "https://automatikoagency.github.io/dpsonline_genera_pdf/aster_logo.png")
+LOGO_LOCAL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "aster_logo.png")
+# Secondi dopo i quali il logo viene rivalidato sull'URL (0 = mai)
+LOGO_CACHE_TTL = int(os.getenv("LOGO_CACHE_TTL", "3600"))
+
+def flatten_to_rgb(image: Image.Image) -> Image.Image:
+    """
+    Converte un'immagine in RGB, appiattendo l'eventuale trasparenza su sfondo bianco.
+    """
+    if image.mode in ('RGBA', 'LA', 'P'):
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        if image.mode == 'P':
+            image = image.convert('RGBA')
+        background.paste(image, mask=image.split()[-1] if image.mode in ('RGBA', 'LA') else None)
+        return background
+    if image.mode != 'RGB':
+        return image.convert('RGB')
+    return image
+
+class LogoAsset:
+    """
+    Logo gia' decodificato e appiattito in RGB, con lo stream PDF pre-codificato.
+    """
+    def __init__(self, raw_bytes: bytes, source: str, etag: Optional[str] = None):
+        with Image.open(io.BytesIO(raw_bytes)) as img:
+            self.image = flatten_to_rgb(img)
+            self.image.load()
+        self.width, self.height = self.image.size
+        self.source = source
+        self.etag = etag
+        self.version = hashlib.sha1(raw_bytes).hexdigest()[:12]
+        self.loaded_at = time.monotonic()
+        # Stream PDF compresso una sola volta per processo, incorporato con embed_image_stream
+        self.xobject_name = f"logo_{self.version}"
+        self.stream = zlib.compress(self.image.tobytes())
+
+    def height_for_width(self, width_pt: float) -> float:
+        return (self.height / self.width) * width_pt
+
+class LogoCache:
+    """
+    Cache di processo del logo: caricato una volta all'avvio, rivalidato dopo il TTL
+    tramite ETag e con fallback sul file aster_logo.png incluso nel repository.
+    La rivalidazione gira in un thread a parte: intanto get() restituisce subito
+    il logo attuale, senza attendere la rete.
+    """
+    def __init__(self, url: str, local_path: str, ttl: int):
+        self.url = url
+        self.local_path = local_path
+        self.ttl = ttl
+        self._asset: Optional[LogoAsset] = None
+        self._lock = threading.Lock()
+        self._revalidating = False
+
+    def get(self) -> Optional[LogoAsset]:
+        with self._lock:
+            if self._asset is None:
+                self._asset = self._download() or self._load_local()
+            elif (self.ttl > 0 and not self._revalidating
+                  and time.monotonic() - self._asset.loaded_at > self.ttl):
+                self._revalidating = True
+                threading.Thread(target=self._revalidate, name="logo-revalidate", daemon=True).start()
+            return self._asset
+
+    def _download(self, etag: Optional[str] = None) -> Optional[LogoAsset]:
+        if not self.url:
+            return None
+        try:
+            logger.info("Scaricando logo da: %s", self.url)
+            headers = {"If-None-Match": etag} if etag else {}
+            response = http_session.get(self.url, headers=headers, timeout=10)
+            if response.status_code == 304:
+                return None
+            response.raise_for_status()
+            logger.info("Logo scaricato con successo: %d bytes", len(response.content))
+            return LogoAsset(response.content, self.url, response.headers.get("ETag"))
+        except Exception as e:
+            logger.error("Errore nel download del logo: %s", e)
+            return None
+
+    def _load_local(self) -> Optional[LogoAsset]:
+        try:
+            with open(self.local_path, 'rb') as f:
+                asset = LogoAsset(f.read(), self.local_path)
+            logger.info("Logo caricato dal file locale: %s", self.local_path)
+            return asset
+        except Exception as e:
+            logger.error("Errore nel caricamento del logo locale: %s", e)
+            return None
+
+    def _revalidate(self):
+        current = self._asset
+        fresh = None
+        try:
+            etag = current.etag if current.source == self.url else None
+            fresh = self._download(etag)
+        finally:
+            with self._lock:
+                if fresh is not None:
+                    self._asset = fresh
+                else:
+                    # 304, errore di rete o nessun URL: si continua a usare il logo attuale
+                    current.loaded_at = time.monotonic()
+                self._revalidating = False
+
+logo_cache = LogoCache(LOGO_URL, LOGO_LOCAL_PATH, LOGO_CACHE_TTL)
+
+LOGO_HEADER_FORM = "logo_intestazione"
+HEADER_LOGO_WIDTH_PT = 120 * 0.75
+COVER_LOGO_WIDTH_PT = 180 * 0.75
+
+def register_logo_header(c: canvas.Canvas, logo: LogoAsset, margin: float = 50) -> float:
+    """
+    Registra il logo di intestazione come form XObject del documento.
+    Le pagine lo richiamano per nome con c.doForm(LOGO_HEADER_FORM), quindi
+    l'immagine viene incorporata una sola volta. Restituisce l'altezza in punti.
+    """
+    page_height = c._pagesize[1]
+    logo_height_pt = logo.height_for_width(HEADER_LOGO_WIDTH_PT)
+    if c.hasForm(LOGO_HEADER_FORM):
+        return logo_height_pt
+    embed_logo(c, logo)
+    c.beginForm(LOGO_HEADER_FORM)
+    draw_image_stream(c, logo.xobject_name, margin, page_height - margin - logo_height_pt,
+                      HEADER_LOGO_WIDTH_PT, logo_height_pt)
+    c.endForm()
+    return logo_height_pt
+
+# Titolo predefinito della copertina (sostituibile con il campo 'titolo' o l'header 'x-titolo')
+COVER_TITLE = os.getenv("PDF_COVER_TITLE", "SELEZIONE STAMPA")
+COVER_TITLE_MAX_CHARS = 120
+COVER_FONT = "Helvetica-Bold"
+COVER_CACHE_ITEMS = 32
+ITALIAN_MONTHS = ["Gennaio", "Febbraio", "Marzo", "Aprile", "Maggio", "Giugno",
+                  "Luglio", "Agosto", "Settembre", "Ottobre", "Novembre", "Dicembre"]
+
+class CoverLayout:
+    """
+    Copertina gia' impaginata per un giorno, un titolo e una versione del logo:
+    testi, corpo del font e posizioni. Il disegno si riduce a un XObject e due stringhe.
+    """
+    def __init__(self, title: str, day: date, logo: Optional[LogoAsset], page_size=A4, margin: float = 50):
+        page_width, page_height = page_size
+        max_text_width = page_width - 2 * margin
+        self.title = title
+        self.date_text = f"{day.day} {ITALIAN_MONTHS[day.month - 1]} {day.year}"
+        
+        # Corpo massimo (fino a 50pt, minimo 10pt) con cui il titolo sta nella pagina
+        self.font_size = 50
+        while self.font_size > 10 and stringWidth(title, COVER_FONT, self.font_size) > max_text_width:
+            self.font_size -= 1
+        
+        self.title_x = (page_width - stringWidth(title, COVER_FONT, self.font_size)) / 2
+        self.title_y = page_height * 0.55
+        self.date_x = (page_width - stringWidth(self.date_text, COVER_FONT, self.font_size)) / 2
+        self.date_y = self.title_y - 70
+        
+        self.logo_box = None
+        if logo:
+            self.logo_box = ((page_width - COVER_LOGO_WIDTH_PT) / 2, page_height * 0.75,
+                             COVER_LOGO_WIDTH_PT, logo.height_for_width(COVER_LOGO_WIDTH_PT))
+
+class CoverCache:
+    """
+    Copertine impaginate (LRU) per chiave (giorno, titolo, versione del logo):
+    si ricalcolano solo al cambio di data, titolo o logo.
+    """
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self._layouts: "OrderedDict[tuple, CoverLayout]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, title: str, logo: Optional[LogoAsset]) -> CoverLayout:
+        today = date.today()
+        key = (today.isoformat(), title, logo.version if logo else None)
+        with self._lock:
+            layout = self._layouts.get(key)
+            if layout is not None:
+                self._layouts.move_to_end(key)
+                self.hits += 1
+                return layout
+        layout = CoverLayout(title, today, logo)
+        with self._lock:
+            self.misses += 1
+            self._layouts[key] = layout
+            while len(self._layouts) > self.max_items:
+                self._layouts.popitem(last=False)
+        return layout
+
+    def stats(self) -> Dict[str, Any]:
+        return {"items": len(self._layouts), "hits": self.hits, "misses": self.misses}
+
+cover_cache = CoverCache(COVER_CACHE_ITEMS)
+
+def draw_cover_page(c: canvas.Canvas, layout: CoverLayout, logo: Optional[LogoAsset]):
+    """Disegna la copertina sulla pagina corrente a partire dall'impaginazione in cache."""
+    if logo and layout.logo_box:
+        try:
+            embed_logo(c, logo)
+            draw_image_stream(c, logo.xobject_name, *layout.logo_box)
+        except Exception as e:
+            logger.error("Errore logo copertina: %s", e)
+    c.setFont(COVER_FONT, layout.font_size)
+    c.drawString(layout.title_x, layout.title_y, layout.title)
+    c.drawString(layout.date_x, layout.date_y, layout.date_text)
+
+def clean_cover_title(value: Optional[str]) -> Optional[str]:
+    """Titolo della copertina ricevuto dalla richiesta: spazi normalizzati e lunghezza limitata."""
+    if not value:
+        return None
+    title = " ".join(unquote(value).split())[:COVER_TITLE_MAX_CHARS]
+    return title or None
+
+# Tag EXIF Orientation (1 = nessuna rotazione)
+EXIF_ORIENTATION_TAG = 0x0112
+
+# Orientamenti EXIF che scambiano larghezza e altezza
+EXIF_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+def jpeg_passthrough_info(img: Image.Image) -> Optional[str]:
+    """
+    Verifica, dalla sola intestazione, se un JPEG aperto puo' essere incorporato
+    direttamente nel PDF come stream DCTDecode. Restituisce lo spazio colore
+    oppure None se serve la decodifica (CMYK, EXIF ruotato, formato non supportato).
+    """
+    if img.format != 'JPEG' or img.mode not in ('RGB', 'L'):
+        return None
+    if img.getexif().get(EXIF_ORIENTATION_TAG, 1) != 1:
+        return None
+    return 'DeviceRGB' if img.mode == 'RGB' else 'DeviceGray'
+
+def embed_image_stream(c: canvas.Canvas, name: str, width: int, height: int,
+                       color_space: str, filters: tuple, stream: bytes):
+    """
+    Registra uno stream immagine gia' codificato come XObject del documento,
+    senza decodificarlo. Stream con lo stesso nome vengono incorporati una volta sola.
+    """
+    reg_name = c._doc.getXObjectName(name)
+    if c._doc.idToObject.get(reg_name) is None:
+        img_obj = pdfdoc.PDFImageXObject(name)
+        img_obj.width = width
+        img_obj.height = height
+        img_obj.bitsPerComponent = 8
+        img_obj.colorSpace = color_space
+        img_obj._filters = filters
+        img_obj.streamContent = stream
+        img_obj.mask = None
+        c._setXObjects(img_obj)
+        c._doc.Reference(img_obj, reg_name)
+        c._doc.addForm(name, img_obj)
+
+def embed_logo(c: canvas.Canvas, logo: LogoAsset):
+    """Incorpora nel documento lo stream gia' compresso del logo (una volta per documento)."""
+    embed_image_stream(c, logo.xobject_name, logo.width, logo.height, 'DeviceRGB',
+                       ('FlateDecode',), logo.stream)
+
+def draw_image_stream(c: canvas.Canvas, name: str, x: float, y: float, width: float, height: float):
+    """Disegna un XObject registrato con embed_image_stream nel riquadro indicato."""
+    c.saveState()
+    c.translate(x, y)
+    c.scale(width, height)
+    c._code.append("/%s Do" % c._doc.getXObjectName(name))
+    c.restoreState()
+    c._formsinuse.append(name)
+    c._currentPageHasImages = 1
+
+# Numero di worker per la preparazione delle immagini (1 = nel thread della richiesta)
+IMAGE_WORKERS = int(os.getenv("PDF_IMAGE_WORKERS", str(os.cpu_count() or 1)))
+# Tipo di pool: "process" (usa tutti i core) oppure "thread"
+IMAGE_EXECUTOR = os.getenv("PDF_IMAGE_EXECUTOR", "process")
+LOSSLESS_EXTENSIONS = ('.png', '.gif', '.bmp', '.tiff')
+LOSSLESS_FORMATS = ('PNG', 'GIF', 'BMP', 'TIFF')
+# Risoluzione di destinazione predefinita in DPI (0 = nessun ricampionamento)
+DEFAULT_TARGET_DPI = int(os.getenv("PDF_TARGET_DPI", "200"))
+# Si ricampiona solo se l'immagine supera di oltre il 10% la dimensione necessaria
+DOWNSAMPLE_TOLERANCE = 1.1
+# Differenza massima tra i canali RGB perche' un'immagine sia considerata in scala di grigi
+GRAYSCALE_TOLERANCE = 4
+
+class OutputProfile(BaseModel):
+    """
+    Profilo di uscita: risoluzione e codifica delle immagini del PDF.
+    jpeg_quality vale per le immagini ricodificate; con lossless_to_jpeg anche
+    PNG/GIF/BMP/TIFF e screenshot diventano JPEG; con grayscale le immagini senza
+    colore vengono salvate su un solo canale; flate_level e' il livello zlib degli
+    stream senza perdita; con reencode_jpeg i JPEG vengono ricompressi anche se
+    non vanno ricampionati (si tiene l'originale se e' piu' piccolo).
+    """
+    target_dpi: int
+    jpeg_quality: int = 100
+    lossless_to_jpeg: bool = False
+    grayscale: bool = False
+    flate_level: int = 6
+    reencode_jpeg: bool = False
+
+# Profili selezionabili per richiesta (header 'x-profilo' o campo form 'profilo')
+OUTPUT_PROFILES: Dict[str, OutputProfile] = {
+    # Predefinito: JPEG a qualita' 100 ricampionati a PDF_TARGET_DPI, nessuna conversione di colore o formato
+    "standard": OutputProfile(target_dpi=DEFAULT_TARGET_DPI),
+    # Stampa: alta risoluzione, grafica senza perdita
+    "print": OutputProfile(target_dpi=300, jpeg_quality=95, grayscale=True, flate_level=9),
+    # Lettura a video
+    "screen": OutputProfile(target_dpi=150, jpeg_quality=85, grayscale=True, flate_level=9),
+    # Allegato e-mail: il file piu' piccolo possibile
+    "email": OutputProfile(target_dpi=100, jpeg_quality=70, lossless_to_jpeg=True, grayscale=True,
+                           flate_level=9, reencode_jpeg=True),
+}
+DEFAULT_PROFILE = os.getenv("PDF_OUTPUT_PROFILE", "standard")
+if DEFAULT_PROFILE not in OUTPUT_PROFILES:
+    raise ValueError(f"PDF_OUTPUT_PROFILE non valido: {DEFAULT_PROFILE} (ammessi: {', '.join(OUTPUT_PROFILES)})")
+
+class RenderOptions(BaseModel):
+    """Opzioni di generazione del PDF, da header o campi form della richiesta."""
+    target_dpi: int = OUTPUT_PROFILES[DEFAULT_PROFILE].target_dpi
+    screenshot_cache: str = "use"
+    cover_title: str = COVER_TITLE
+    profile: str = DEFAULT_PROFILE
+    
+    def output_profile(self) -> OutputProfile:
+        return OUTPUT_PROFILES[self.profile]
+
+class PreparedImage:
+    """
+    Immagine pronta per il canvas: stream gia' codificato per il PDF e
+    dimensioni di disegno. Viene prodotta dai worker e serializzata tra processi.
+    """
+    def __init__(self, filename: str, error: Optional[str] = None):
+        self.filename = filename
+        self.error = error
+        self.name = ""
+        self.width = 0
+        self.height = 0
+        self.color_space = 'DeviceRGB'
+        self.filters: tuple = ()
+        self.stream = b""
+        self.passthrough = False
+        self.downsampled = False
+        self.grayscale = False
+        # Copia di un'immagine identica gia' incorporata: lo stream resta vuoto
+        self.duplicate = False
+        self.source_bytes = 0
+        self.scaled_width = 0.0
+        self.scaled_height = 0.0
+        # Tempi del worker in secondi: lettura/decodifica e codifica dello stream
+        self.decode_time = 0.0
+        self.encode_time = 0.0
+
+def target_pixel_size(width_pt: float, height_pt: float, target_dpi: int) -> tuple:
+    """Dimensioni in pixel di un riquadro di width_pt x height_pt punti alla risoluzione indicata."""
+    return (max(1, math.ceil(width_pt / 72 * target_dpi)),
+            max(1, math.ceil(height_pt / 72 * target_dpi)))
+
+def is_grayscale(img: Image.Image) -> bool:
+    """True se i tre canali di un'immagine RGB coincidono (a meno di GRAYSCALE_TOLERANCE)."""
+    red, green, blue = img.split()
+    return all(ImageChops.difference(first, second).getextrema()[1] <= GRAYSCALE_TOLERANCE
+               for first, second in ((red, green), (green, blue)))
+
+def prepare_image(filename: str, image_data: bytes, max_width: float, max_height: float,
+                  target_dpi: int = 0, lossless: Optional[bool] = None,
+                  image_format: Optional[str] = None,
+                  profile: Optional[OutputProfile] = None) -> PreparedImage:
     """
-    Scarica il logo da URL e lo restituisce come bytes.
+    Worker: appiattisce la trasparenza, converte il modo colore, codifica lo
+    stream per il PDF e calcola la scala per il riquadro max_width x max_height.
+    Con target_dpi > 0 le immagini piu' grandi del necessario vengono ricampionate
+    alla dimensione in pixel che occupano davvero sulla pagina.
+    Se lossless non e' indicato, si decide in base al formato gia' riconosciuto
+    (image_format) o all'estensione del file. La codifica segue il profilo di
+    uscita (predefinito: "standard").
     """
-    logo_url = "https://automatikoagency.github.io/dpsonline_genera_pdf/aster_logo.png"
+    profile = profile or OUTPUT_PROFILES["standard"]
+    if lossless is None:
+        if image_format:
+            lossless = image_format in LOSSLESS_FORMATS
+        else:
+            lossless = filename.lower().endswith(LOSSLESS_EXTENSIONS)
+    prepared = PreparedImage(filename)
+    prepared.source_bytes = len(image_data)
+    started = time.perf_counter()
     try:
-        print(f"Scaricando logo da: {logo_url}")
-        response = requests.get(logo_url, timeout=10)
-        response.raise_for_status()
-        print(f"Logo scaricato con successo: {len(response.content)} bytes")
-        return response.content
+        with Image.open(io.BytesIO(image_data), formats=[image_format] if image_format else None) as img:
+            # Dimensioni di visualizzazione lette dall'intestazione, senza decodificare
+            orientation = img.getexif().get(EXIF_ORIENTATION_TAG, 1)
+            display_width, display_height = img.size
+            if orientation in EXIF_TRANSPOSED_ORIENTATIONS:
+                display_width, display_height = display_height, display_width
+            
+            scale = min(max_width / display_width, max_height / display_height)
+            prepared.scaled_width = display_width * scale
+            prepared.scaled_height = display_height * scale
+            
+            target_size = None
+            if target_dpi > 0:
+                target_size = target_pixel_size(prepared.scaled_width, prepared.scaled_height, target_dpi)
+                if display_width <= target_size[0] * DOWNSAMPLE_TOLERANCE:
+                    target_size = None
+            
+            color_space = jpeg_passthrough_info(img)
+            if color_space and target_size is None and not profile.reencode_jpeg:
+                # Percorso veloce: il JPEG viene incorporato cosi' com'e' (DCTDecode)
+                prepared.width, prepared.height = display_width, display_height
+                prepared.color_space = color_space
+                prepared.filters = ('DCTDecode',)
+                prepared.stream = image_data
+                prepared.passthrough = True
+            else:
+                if target_size and img.format == 'JPEG':
+                    # Decodifica JPEG gia' ridotta (1/2, 1/4, 1/8) quando possibile
+                    draft_size = target_size
+                    if orientation in EXIF_TRANSPOSED_ORIENTATIONS:
+                        draft_size = (target_size[1], target_size[0])
+                    img.draft(None, draft_size)
+                img = flatten_to_rgb(ImageOps.exif_transpose(img))
+                if target_size:
+                    if img.width > target_size[0]:
+                        img = img.resize(target_size, Image.LANCZOS)
+                    prepared.downsampled = True
+                prepared.width, prepared.height = img.size
+                decoded = time.perf_counter()
+                prepared.decode_time = decoded - started
+                if profile.grayscale and is_grayscale(img):
+                    # Un solo canale: un terzo dei pixel da comprimere
+                    img = img.convert('L')
+                    prepared.grayscale = True
+                prepared.color_space = 'DeviceGray' if prepared.grayscale else 'DeviceRGB'
+                if lossless and not profile.lossless_to_jpeg:
+                    # Senza perdita: pixel compressi con zlib, come farebbe reportlab
+                    prepared.filters = ('FlateDecode',)
+                    prepared.stream = zlib.compress(img.tobytes(), profile.flate_level)
+                else:
+                    img_buffer = io.BytesIO()
+                    img.save(img_buffer, format='JPEG', quality=profile.jpeg_quality)
+                    prepared.filters = ('DCTDecode',)
+                    prepared.stream = img_buffer.getvalue()
+                    if color_space and not prepared.downsampled and len(prepared.stream) >= len(image_data):
+                        # La ricompressione non conviene: si tiene il JPEG originale
+                        prepared.width, prepared.height = display_width, display_height
+                        prepared.color_space = color_space
+                        prepared.stream = image_data
+                        prepared.passthrough = True
+                        prepared.grayscale = False
+                prepared.encode_time = time.perf_counter() - decoded
+        
+        prepared.name = hashlib.md5(prepared.stream).hexdigest()
+        if prepared.passthrough:
+            prepared.decode_time = time.perf_counter() - started
     except Exception as e:
-        print(f"ERRORE nel download del logo: {e}")
+        prepared.error = str(e)
+    return prepared
+
+_image_executor = None
+_image_executor_lock = threading.Lock()
+
+def get_image_executor():
+    """Restituisce il pool condiviso per la preparazione immagini (None se disattivato)."""
+    global _image_executor
+    if IMAGE_WORKERS <= 1:
         return None
+    with _image_executor_lock:
+        if _image_executor is None:
+            if IMAGE_EXECUTOR == "thread":
+                _image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="pdf-img")
+            else:
+                # "spawn" evita di fare fork di un processo con thread attivi
+                _image_executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS,
+                                                      mp_context=multiprocessing.get_context("spawn"))
+        return _image_executor
 
-def create_pdf_from_images(zip_binary_data: bytes) -> bytes:
+def discard_image_executor(executor):
     """
-    Crea un PDF dalle immagini contenute nel file ZIP.
-    Ogni immagine diventa una pagina del PDF.
+    Scarta un pool rotto (un processo e' terminato per memoria esaurita, crash o kill):
+    il successivo get_image_executor ne crea uno nuovo invece di fallire per sempre.
     """
-    pdf_buffer = io.BytesIO()
+    global _image_executor
+    with _image_executor_lock:
+        if _image_executor is not executor:
+            # Gia' sostituito da un'altra richiesta
+            return
+        _image_executor = None
+    logger.warning("Pool immagini interrotto da un processo terminato, verra' ricreato")
+    executor.shutdown(wait=False, cancel_futures=True)
+
+def shutdown_image_executor():
+    global _image_executor
+    with _image_executor_lock:
+        if _image_executor is not None:
+            _image_executor.shutdown(wait=True)
+            _image_executor = None
+
+def image_area(page_width: float, page_height: float, header_logo_height_pt: float = 0,
+               margin: float = 50) -> Tuple[float, float, float]:
+    """Larghezza e altezza massime delle immagini e margine superiore, sotto il logo di intestazione."""
+    logo_space_height = header_logo_height_pt + 1 if header_logo_height_pt else 0
+    margin_top = margin + logo_space_height
+    return page_width - 2 * margin, page_height - margin - margin_top, margin_top
+
+def duplicate_image(prepared: PreparedImage, filename: str) -> PreparedImage:
+    """
+    Copia senza stream di un'immagine gia' preparata con lo stesso contenuto:
+    nel PDF si richiama l'XObject gia' incorporato con lo stesso nome.
+    """
+    duplicate = PreparedImage(filename, prepared.error)
+    for attribute in ("name", "width", "height", "color_space", "filters", "passthrough",
+                      "downsampled", "grayscale", "source_bytes", "scaled_width", "scaled_height"):
+        setattr(duplicate, attribute, getattr(prepared, attribute))
+    duplicate.duplicate = True
+    return duplicate
+
+def prepare_images(zip_ref: zipfile.ZipFile, filenames: List[str], max_width: float, max_height: float,
+                   target_dpi: int = 0, formats: Optional[Dict[str, str]] = None,
+                   prepared: Optional[Dict[str, PreparedImage]] = None,
+                   profile: Optional[OutputProfile] = None, dedupe: bool = True):
+    """
+    Prepara le immagini sul pool e le restituisce nell'ordine di filenames.
+    Al massimo 2 x worker immagini sono in lavorazione contemporaneamente,
+    cosi' la memoria resta limitata anche con ZIP molto grandi.
+    formats contiene i formati gia' riconosciuti da select_image_entries;
+    le immagini presenti in prepared (gia' pronte) non vengono rielaborate.
+    I file con lo stesso contenuto (stesso hash) vengono preparati una volta sola:
+    i successivi tornano come duplicati senza stream (vedi duplicate_image), da
+    disegnare sullo stesso canvas. Con dedupe=False ogni immagine ha il suo stream.
+    """
+    if prepared:
+        computed = prepare_images(zip_ref, [f for f in filenames if f not in prepared],
+                                  max_width, max_height, target_dpi, formats, profile=profile)
+        for filename in filenames:
+            yield prepared[filename] if filename in prepared else next(computed)
+        return
+    
+    formats = formats or {}
+    submitted = set()
+    # Hash del contenuto -> immagine gia' restituita (senza stream, per non tenerlo in memoria)
+    seen: Dict[str, PreparedImage] = {}
+    
+    def digest_of(filename: str, data: bytes) -> str:
+        # Senza deduplicazione la chiave e' il nome del file, sempre diverso
+        return hashlib.md5(data).hexdigest() if dedupe else filename
+    
+    def remember(digest: str, result: PreparedImage) -> PreparedImage:
+        seen[digest] = duplicate_image(result, result.filename)
+        return result
+    
+    if get_image_executor() is None:
+        for filename in filenames:
+            data = zip_ref.read(filename)
+            digest = digest_of(filename, data)
+            if digest in seen:
+                yield duplicate_image(seen[digest], filename)
+                continue
+            yield remember(digest, prepare_image(filename, data, max_width, max_height, target_dpi,
+                                               image_format=formats.get(filename), profile=profile))
+        return
+    
+    def submit_to_pool(filename: str, data: bytes):
+        # Un pool gia' rotto rifiuta i nuovi lavori: lo si sostituisce e si riprova una volta
+        for attempt in range(2):
+            pool = get_image_executor()
+            try:
+                return pool, pool.submit(prepare_image, filename, data, max_width, max_height,
+                                         target_dpi, None, formats.get(filename), profile)
+            except BrokenProcessPool as e:
+                discard_image_executor(pool)
+                broken = e
+        failed = Future()
+        failed.set_exception(broken)
+        return pool, failed
+    
+    def submit(filename):
+        data = zip_ref.read(filename)
+        digest = digest_of(filename, data)
+        if digest in submitted:
+            # Gia' in lavorazione o pronta: basta attendere la prima occorrenza
+            return filename, digest, None, None
+        submitted.add(digest)
+        pool, future = submit_to_pool(filename, data)
+        return filename, digest, pool, future
     
-    # Scarica il logo una sola volta
-    logo_bytes = download_logo()
-    logo_image = None
-    if logo_bytes:
+    def result_of(filename: str, pool, future, retry: bool = True) -> PreparedImage:
         try:
-            logo_image = Image.open(io.BytesIO(logo_bytes))
-            # Converti in RGB se necessario
-            if logo_image.mode in ('RGBA', 'LA', 'P'):
-                background = Image.new('RGB', logo_image.size, (255, 255, 255))
-                if logo_image.mode == 'P':
-                    logo_image = logo_image.convert('RGBA')
-                background.paste(logo_image, mask=logo_image.split()[-1] if logo_image.mode in ('RGBA', 'LA') else None)
-                logo_image = background
-            elif logo_image.mode != 'RGB':
-                logo_image = logo_image.convert('RGB')
-            print("Logo preparato con successo")
+            return future.result()
+        except BrokenProcessPool as e:
+            # Un processo del pool (per questa o un'altra immagine) e' terminato:
+            # una sola nuova prova su un pool nuovo, poi solo questa pagina risulta in errore
+            discard_image_executor(pool)
+            if retry:
+                return result_of(filename, *submit_to_pool(filename, zip_ref.read(filename)), retry=False)
+            return PreparedImage(filename, error=str(e))
         except Exception as e:
-            print(f"Errore nella preparazione del logo: {e}")
-            logo_image = None
+            return PreparedImage(filename, error=str(e))
+    
+    pending = deque()
+    names = iter(filenames)
+    for filename in names:
+        pending.append(submit(filename))
+        if len(pending) >= IMAGE_WORKERS * 2:
+            break
+    while pending:
+        filename, digest, pool, future = pending.popleft()
+        next_name = next(names, None)
+        if next_name is not None:
+            pending.append(submit(next_name))
+        if future is None:
+            yield duplicate_image(seen[digest], filename)
+            continue
+        yield remember(digest, result_of(filename, pool, future))
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp')
+# Byte iniziali letti per riconoscere le immagini senza estensione
+SNIFF_BYTES = 16
+# Magic number dei formati supportati (il WEBP si controlla a parte: RIFF....WEBP)
+IMAGE_MAGIC_NUMBERS = (
+    (b'\xff\xd8\xff', 'JPEG'),
+    (b'\x89PNG\r\n\x1a\n', 'PNG'),
+    (b'GIF87a', 'GIF'),
+    (b'GIF89a', 'GIF'),
+    (b'BM', 'BMP'),
+    (b'II*\x00', 'TIFF'),
+    (b'MM\x00*', 'TIFF'),
+)
+def sniff_image_format(header: bytes) -> Optional[str]:
+    """Formato dell'immagine dai primi byte del file, None se non riconosciuto."""
+    for magic, image_format in IMAGE_MAGIC_NUMBERS:
+        if header.startswith(magic):
+            return image_format
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'WEBP'
+    return None
+
+def is_zip_metadata(info: zipfile.ZipInfo) -> bool:
+    """Cartelle e file di servizio di macOS (__MACOSX/, ._nome) da non considerare."""
+    if info.is_dir():
+        return True
+    parts = info.filename.split('/')
+    return '__MACOSX' in parts or parts[-1].startswith('._')
+
+def select_image_entries(zip_ref: zipfile.ZipFile) -> Tuple[List[str], Dict[str, str]]:
+    """
+    Elenca le immagini dello ZIP usando solo i metadati (ZipInfo) e, per i file
+    senza estensione nota, i primi SNIFF_BYTES byte decompressi.
+    Restituisce i nomi e il formato riconosciuto per i file senza estensione,
+    da passare alla preparazione cosi' nessun file viene letto due volte per intero.
+    """
+    image_files = []
+    image_formats: Dict[str, str] = {}
+    for info in zip_ref.infolist():
+        if is_zip_metadata(info):
+            continue
+        filename = info.filename
+        if filename.lower().endswith(IMAGE_EXTENSIONS):
+            image_files.append(filename)
+            continue
+        try:
+            with zip_ref.open(info) as entry:
+                image_format = sniff_image_format(entry.read(SNIFF_BYTES))
+        except Exception:
+            image_format = None
+        if image_format is None:
+            logger.debug("File %s saltato: non è un'immagine", filename)
+            continue
+        logger.debug("File %s riconosciuto come immagine %s (senza estensione)", filename, image_format)
+        image_files.append(filename)
+        image_formats[filename] = image_format
+    return image_files, image_formats
+
+def create_pdf_from_images(zip_binary_data: Union[bytes, BinaryIO], options: Optional[RenderOptions] = None,
+                           stats: Optional[Dict[str, Any]] = None,
+                           screenshots: Optional[Iterable[Tuple[str, Optional[bytes]]]] = None,
+                           output: Optional[BinaryIO] = None,
+                           progress: Optional[Callable[[int, int], None]] = None,
+                           screenshot_count: int = 0,
+                           only_images: Optional[Iterable[str]] = None,
+                           shared_images: Optional[Dict[str, PreparedImage]] = None) -> Optional[bytes]:
+    """
+    Crea un PDF dalle immagini contenute nel file ZIP.
+    Ogni immagine diventa una pagina del PDF.
+    Lo ZIP puo' essere passato come bytes o come file aperto (seekable): le
+    immagini vengono lette e decodificate una alla volta durante il disegno.
+    Le coppie (link, screenshot) di screenshots vengono aggiunte in coda sullo stesso
+    canvas, cosi' il documento viene scritto una sola volta; l'iterabile viene letto
+    solo dopo le pagine delle immagini.
+    Se stats e' un dizionario, vi vengono riportate le dimensioni in ingresso e in uscita.
+    Se output e' un file aperto, il PDF viene scritto li' e la funzione restituisce None;
+    altrimenti restituisce i bytes del PDF.
+    progress, se indicato, riceve (pagine completate, pagine totali) dopo ogni pagina;
+    screenshot_count e' il numero di link attesi in screenshots, per il totale.
+    only_images limita il PDF alle immagini indicate; shared_images contiene
+    immagini gia' preparate (condivise tra i report di un batch).
+    """
+    options = options or RenderOptions()
+    if stats is None:
+        stats = {}
+    if isinstance(zip_binary_data, (bytes, bytearray)):
+        zip_stream = io.BytesIO(zip_binary_data)
+    else:
+        zip_stream = zip_binary_data
+    input_bytes = zip_stream.seek(0, os.SEEK_END)
+    zip_stream.seek(0)
+    stats.update(input_bytes=input_bytes, images_input_bytes=0, images_output_bytes=0,
+                 images_downsampled=0, images_grayscale=0, images_deduplicated=0,
+                 screenshot_pages=0, profile=options.profile)
+    # Tempi per fase in secondi; decode/encode sommano i tempi dei worker
+    timings = stats["timings"] = dict(zip_parse=0.0, decode=0.0, encode=0.0, draw=0.0,
+                                      screenshots=0.0, save=0.0, total=0.0)
+    started = time.perf_counter()
+    INPUT_BYTES.inc(input_bytes)
+    pdf_buffer = output if output is not None else io.BytesIO()
+    output_start = pdf_buffer.tell()
+    
+    # Logo dalla cache di processo (gia' appiattito in RGB)
+    logo = logo_cache.get()
+    profile = options.output_profile()
     
     try:
-        with zipfile.ZipFile(io.BytesIO(zip_binary_data), 'r') as zip_ref:
+        with zipfile.ZipFile(zip_stream, 'r') as zip_ref:
             # Crea il PDF
             c = canvas.Canvas(pdf_buffer, pagesize=A4)
             page_width, page_height = A4
             
             # Lista tutti i file nel ZIP
             file_list = zip_ref.namelist()
-            print(f"\nCreazione PDF: trovati {len(file_list)} file nel ZIP")
+            logger.info("Creazione PDF: trovati %d file nel ZIP", len(file_list))
             
-            # Filtra solo i file immagine (per sicurezza)
-            image_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp']
-            image_files = []
+            # Filtra solo i file immagine (per sicurezza): estensione o magic number
+            image_files, image_formats = select_image_entries(zip_ref)
+            if only_images is not None:
+                wanted = set(only_images)
+                image_files = [f for f in image_files if f in wanted]
+            timings["zip_parse"] = time.perf_counter() - started
+            STAGE_SECONDS.labels("zip_parse").observe(timings["zip_parse"])
             
-            for filename in file_list:
-                is_image = any(filename.lower().endswith(ext) for ext in image_extensions)
-                if not is_image:
-                    try:
-                        file_data = zip_ref.read(filename)
-                        Image.open(io.BytesIO(file_data))
-                        is_image = True
-                        print(f"File {filename} riconosciuto come immagine (senza estensione)")
-                    except:
-                        print(f"File {filename} saltato: non è un'immagine")
-                        continue
-                
-                if is_image:
-                    image_files.append(filename)
+            logger.info("File immagine trovati: %d", len(image_files))
+            logger.debug("File immagine: %s", image_files)
             
-            print(f"File immagine trovati: {image_files}")
+            # Copertina (o pagina di errore) + immagini + screenshot
+            pages_total = 1 + len(image_files) + screenshot_count
+            def report_progress(pages_done: int):
+                if progress:
+                    progress(pages_done, pages_total)
+            report_progress(0)
             
             if not image_files:
-                print("ERRORE: Nessuna immagine trovata nel ZIP!")
+                logger.warning("Nessuna immagine trovata nel ZIP")
                 c.drawString(100, 750, "Nessuna immagine trovata nel file ZIP")
                 c.showPage()
+                report_progress(1)
             else:
-                # PRIMA PAGINA: COPERTINA CON LOGO E TITOLO
-                print("Creazione pagina di copertina...")
+                # PRIMA PAGINA: COPERTINA CON LOGO E TITOLO (impaginazione in cache per giorno)
+                layout = cover_cache.get(options.cover_title, logo)
+                draw_cover_page(c, layout, logo)
+                logger.debug("Copertina creata: %s - %s (font %dpt)", layout.title, layout.date_text, layout.font_size)
                 
-                if logo_image:
+                c.showPage()
+                PAGES.labels("cover").inc()
+                report_progress(1)
+                
+                # Il logo di intestazione viene registrato una volta e richiamato in ogni pagina
+                header_logo_height_pt = 0
+                if logo:
                     try:
-                        logo_buffer = io.BytesIO()
-                        logo_image.save(logo_buffer, format='PNG')
-                        logo_buffer.seek(0)
-                        
-                        cover_logo_width_px = 180
-                        cover_logo_width_pt = cover_logo_width_px * 0.75
-                        logo_original_width, logo_original_height = logo_image.size
-                        cover_logo_height_pt = (logo_original_height / logo_original_width) * cover_logo_width_pt
-                        
-                        logo_x = (page_width - cover_logo_width_pt) / 2
-                        logo_y = page_height * 0.75
-                        
-                        c.drawImage(ImageReader(logo_buffer), logo_x, logo_y, cover_logo_width_pt, cover_logo_height_pt)
-                        print(f"Logo copertina aggiunto ({cover_logo_width_pt:.0f}x{cover_logo_height_pt:.0f} pt)")
+                        header_logo_height_pt = register_logo_header(c, logo)
                     except Exception as e:
-                        print(f"Errore logo copertina: {e}")
-                
-                margin = 50
-                max_text_width = page_width - 2 * margin
-                
-                title_text = "SELEZIONE STAMPA"
-                font_size = 50
-                while font_size > 10:
-                    title_width = c.stringWidth(title_text, "Helvetica-Bold", font_size)
-                    if title_width <= max_text_width:
-                        break
-                    font_size -= 1
-                
-                c.setFont("Helvetica-Bold", font_size)
-                title_width = c.stringWidth(title_text, "Helvetica-Bold", font_size)
-                title_x = (page_width - title_width) / 2
-                title_y = page_height * 0.55
-                c.drawString(title_x, title_y, title_text)
-                
-                today = datetime.now()
-                months = ["Gennaio", "Febbraio", "Marzo", "Aprile", "Maggio", "Giugno",
-                          "Luglio", "Agosto", "Settembre", "Ottobre", "Novembre", "Dicembre"]
-                date_text = f"{today.day} {months[today.month-1]} {today.year}"
-                
-                c.setFont("Helvetica-Bold", font_size)
-                date_width = c.stringWidth(date_text, "Helvetica-Bold", font_size)
-                date_x = (page_width - date_width) / 2
-                date_y = title_y - 70
-                c.drawString(date_x, date_y, date_text)
+                        logger.error("Errore nella registrazione del logo di intestazione: %s", e)
                 
-                print(f"Copertina creata: {title_text} (font {font_size}pt) - {date_text} (font {font_size}pt)")
+                image_files.sort()
                 
-                c.showPage()
+                max_width, max_height, margin_top = image_area(page_width, page_height, header_logo_height_pt)
                 
-                image_files.sort()
+                # Le immagini vengono preparate in parallelo e ritornano in ordine di nome file
+                prepared_images = prepare_images(zip_ref, image_files, max_width, max_height, options.target_dpi,
+                                                 image_formats, shared_images, profile)
                 
-                for i, filename in enumerate(image_files):
-                    print(f"Elaborando immagine {i+1}/{len(image_files)}: {filename}")
+                for i, prepared in enumerate(prepared_images):
+                    filename = prepared.filename
+                    logger.debug("Elaborando immagine %d/%d: %s", i + 1, len(image_files), filename)
                     
                     try:
-                        image_data = zip_ref.read(filename)
+                        if prepared.error:
+                            raise ValueError(prepared.error)
+                        
+                        stats["images_input_bytes"] += prepared.source_bytes
+                        stats["images_output_bytes"] += len(prepared.stream)
+                        stats["images_downsampled"] += int(prepared.downsampled)
+                        stats["images_grayscale"] += int(prepared.grayscale)
+                        stats["images_deduplicated"] += int(prepared.duplicate)
+                        timings["decode"] += prepared.decode_time
+                        timings["encode"] += prepared.encode_time
+                        draw_started = time.perf_counter()
+                        
+                        x = (page_width - prepared.scaled_width) / 2
+                        y = (page_height - margin_top - prepared.scaled_height) / 2
+                        
+                        embed_image_stream(c, prepared.name, prepared.width, prepared.height,
+                                           prepared.color_space, prepared.filters, prepared.stream)
+                        draw_image_stream(c, prepared.name, x, y, prepared.scaled_width, prepared.scaled_height)
+                        
+                        if header_logo_height_pt:
+                            c.doForm(LOGO_HEADER_FORM)
+                        draw_time = time.perf_counter() - draw_started
+                        timings["draw"] += draw_time
+                        if not prepared.duplicate:
+                            STAGE_SECONDS.labels("decode").observe(prepared.decode_time)
+                        if not (prepared.passthrough or prepared.duplicate):
+                            STAGE_SECONDS.labels("encode").observe(prepared.encode_time)
+                        STAGE_SECONDS.labels("draw").observe(draw_time)
+                        PAGES.labels("image").inc()
                         
-                        with Image.open(io.BytesIO(image_data)) as img:
-                            if img.mode in ('RGBA', 'LA', 'P'):
-                                background = Image.new('RGB', img.size, (255, 255, 255))
-                                if img.mode == 'P':
-                                    img = img.convert('RGBA')
-                                background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
-                                img = background
-                            elif img.mode != 'RGB':
-                                img = img.convert('RGB')
-                            
-                            img_buffer = io.BytesIO()
-                            if filename.lower().endswith(('.png', '.gif', '.bmp', '.tiff')):
-                                img.save(img_buffer, format='PNG')
-                            else:
-                                img.save(img_buffer, format='JPEG', quality=100)
-                            img_buffer.seek(0)
-                            
-                            img_width, img_height = img.size
-                            
-                            logo_space_height = 0
-                            if logo_image:
-                                logo_width_px = 120
-                                logo_width_pt = logo_width_px * 0.75
-                                logo_original_width, logo_original_height = logo_image.size
-                                logo_height_pt = (logo_original_height / logo_original_width) * logo_width_pt
-                                logo_space_height = logo_height_pt + 1
-                            
-                            margin = 50
-                            margin_top = margin + logo_space_height
-                            max_width = page_width - 2 * margin
-                            max_height = page_height - margin - margin_top
-                            
-                            scale_x = max_width / img_width
-                            scale_y = max_height / img_height
-                            scale = min(scale_x, scale_y)
-                            
-                            scaled_width = img_width * scale
-                            scaled_height = img_height * scale
-                            
-                            x = (page_width - scaled_width) / 2
-                            y = (page_height - margin_top - scaled_height) / 2
-                            
-                            c.drawImage(ImageReader(img_buffer), x, y, scaled_width, scaled_height)
-                            
-                            if logo_image:
-                                try:
-                                    logo_buffer = io.BytesIO()
-                                    logo_image.save(logo_buffer, format='PNG')
-                                    logo_buffer.seek(0)
-                                    
-                                    logo_width_px = 120
-                                    logo_width_pt = logo_width_px * 0.75
-                                    logo_original_width, logo_original_height = logo_image.size
-                                    logo_height_pt = (logo_original_height / logo_original_width) * logo_width_pt
-                                    
-                                    logo_x = margin
-                                    logo_y = page_height - margin - logo_height_pt
-                                    
-                                    c.drawImage(ImageReader(logo_buffer), logo_x, logo_y, logo_width_pt, logo_height_pt)
-                                    
-                                    print(f"Logo aggiunto alla pagina {i+1} ({logo_width_pt:.0f}x{logo_height_pt:.0f} pt)")
-                                except Exception as e:
-                                    print(f"Errore nell'aggiunta del logo alla pagina {i+1}: {e}")
-                            
-                            print(f"Immagine {filename} aggiunta al PDF ({img_width}x{img_height} -> {scaled_width:.0f}x{scaled_height:.0f})")
+                        mode = "diretto" if prepared.passthrough else ("ricampionato" if prepared.downsampled else "ricodificato")
+                        if prepared.duplicate:
+                            mode = "duplicato"
+                        logger.debug("Immagine %s aggiunta al PDF (%dx%d -> %.0fx%.0f, %s)", filename, prepared.width, prepared.height,
+                                     prepared.scaled_width, prepared.scaled_height, mode)
                     
                     except Exception as e:
-                        print(f"ERRORE nell'elaborazione di {filename}: {e}")
+                        logger.error("Errore nell'elaborazione di %s: %s", filename, e)
+                        FAILURES.labels("image").inc()
                         c.drawString(100, 400, f"Errore nel caricare l'immagine: {filename}")
                         c.drawString(100, 380, f"Errore: {str(e)}")
                     
-                    if i < len(image_files) - 1:
-                        c.showPage()
+                    c.showPage()
+                    report_progress(i + 2)
             
+            # PAGINE SCREENSHOT (comprende l'attesa dei download)
+            screenshots_started = time.perf_counter()
+            screenshot_start = 1 + len(image_files)
+            stats["screenshot_pages"] = draw_screenshot_pages(
+                c, screenshots, logo, options.target_dpi,
+                lambda links_done: report_progress(screenshot_start + links_done), profile)
+            timings["screenshots"] = time.perf_counter() - screenshots_started
+            STAGE_SECONDS.labels("screenshot_pages").observe(timings["screenshots"])
+            PAGES.labels("screenshot").inc(stats["screenshot_pages"])
+            
+            save_started = time.perf_counter()
             c.save()
+            timings["save"] = time.perf_counter() - save_started
+            STAGE_SECONDS.labels("save").observe(timings["save"])
             
-        pdf_buffer.seek(0)
-        pdf_bytes = pdf_buffer.getvalue()
-        print(f"PDF creato con successo! Dimensione: {len(pdf_bytes)} bytes")
-        return pdf_bytes
+        stats["output_bytes"] = pdf_buffer.tell() - output_start
+        timings["total"] = time.perf_counter() - started
+        OUTPUT_BYTES.inc(stats["output_bytes"])
+        logger.info("PDF creato: %d pagine, %d bytes in %.2f s", pages_total, stats["output_bytes"], timings["total"])
+        return pdf_buffer.getvalue() if output is None else None
         
     except Exception as e:
-        print(f"ERRORE nella creazione del PDF: {e}")
-        error_pdf = io.BytesIO()
-        c = canvas.Canvas(error_pdf, pagesize=A4)
+        logger.exception("Errore nella creazione del PDF: %s", e)
+        FAILURES.labels("render").inc()
+        stats["error"] = str(e)
+        pdf_buffer.seek(output_start)
+        pdf_buffer.truncate()
+        c = canvas.Canvas(pdf_buffer, pagesize=A4)
         c.drawString(100, 750, f"Errore nella creazione del PDF:")
         c.drawString(100, 730, str(e))
+        c.showPage()
+        stats["screenshot_pages"] = draw_screenshot_pages(c, screenshots, logo, options.target_dpi,
+                                                          profile=options.output_profile())
         c.save()
-        error_pdf.seek(0)
-        return error_pdf.getvalue()
+        stats["output_bytes"] = pdf_buffer.tell() - output_start
+        timings["total"] = time.perf_counter() - started
+        OUTPUT_BYTES.inc(stats["output_bytes"])
+        return pdf_buffer.getvalue() if output is None else None
+
+# Timeout complessivo per ogni screenshot, in secondi
+SCREENSHOT_TIMEOUT = float(os.getenv("SCREENSHOT_TIMEOUT", "60"))
+# Numero massimo di screenshot scaricati in parallelo
+SCREENSHOT_MAX_PARALLEL = int(os.getenv("SCREENSHOT_MAX_PARALLEL", "8"))
+screenshot_executor = ThreadPoolExecutor(max_workers=SCREENSHOT_MAX_PARALLEL, thread_name_prefix="screenshot")
+
+SCREENSHOT_WIDTH = 960
+SCREENSHOT_HEIGHT = 1300
+SCREENSHOT_DELAY = 6000
 
-def add_screenshot_to_pdf(pdf_bytes: bytes, link: str) -> bytes:
+# Cache degli screenshot: memoria (LRU) + disco, con scadenza in secondi (0 = disattivata)
+SCREENSHOT_CACHE_TTL = int(os.getenv("SCREENSHOT_CACHE_TTL", "21600"))
+SCREENSHOT_CACHE_MEMORY_ITEMS = int(os.getenv("SCREENSHOT_CACHE_MEMORY_ITEMS", "64"))
+SCREENSHOT_CACHE_DIR = os.getenv("SCREENSHOT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "dpsonline_screenshots"))
+SCREENSHOT_CACHE_MAX_BYTES = int(os.getenv("SCREENSHOT_CACHE_MAX_BYTES", str(500 * 1024 * 1024)))
+# Modalita' per richiesta (header x-screenshot-cache): usa, rigenera o ignora la cache
+SCREENSHOT_CACHE_MODES = ("use", "refresh", "bypass")
+
+def normalize_url(link: str) -> str:
+    """
+    Normalizza un URL per usarlo come chiave di cache: schema e host in minuscolo,
+    senza porta predefinita ne' frammento, percorso vuoto come "/".
     """
-    Aggiunge una pagina con screenshot del link al PDF esistente.
-    Il testo del link mostra solo il dominio, ma punta all'URL completo.
+    parsed = urlparse(unquote(link).strip())
+    scheme = parsed.scheme.lower()
+    netloc = parsed.netloc.lower()
+    if (scheme, netloc.rsplit(':', 1)[-1]) in (("http", "80"), ("https", "443")):
+        netloc = netloc.rsplit(':', 1)[0]
+    path = parsed.path or "/"
+    query = f"?{parsed.query}" if parsed.query else ""
+    return f"{scheme}://{netloc}{path}{query}"
+
+class ScreenshotCache:
     """
+    Cache a due livelli degli screenshot: LRU in memoria e file su disco con
+    dimensione massima (vengono eliminati i piu' vecchi) e scadenza TTL.
+    """
+    def __init__(self, directory: str, ttl: int, memory_items: int, max_disk_bytes: int):
+        self.directory = directory
+        self.ttl = ttl
+        self.memory_items = memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes: Optional[int] = None
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "bypassed": 0, "evictions": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    @staticmethod
+    def key(link: str, width: int, height: int, delay: int, provider: str = "") -> str:
+        raw = f"{provider}|{normalize_url(link)}|{width}|{height}|{delay}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def count(self, name: str):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.img")
+
+    def get(self, key: str) -> Optional[bytes]:
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                stored_at, data = entry
+                if now - stored_at <= self.ttl:
+                    self._memory.move_to_end(key)
+                    self.counters["memory_hits"] += 1
+                    return data
+                del self._memory[key]
+        
+        path = self._path(key)
+        try:
+            stored_at = os.path.getmtime(path)
+            if now - stored_at <= self.ttl:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                self._remember(key, stored_at, data)
+                self.count("disk_hits")
+                return data
+            os.remove(path)
+        except OSError:
+            pass
+        self.count("misses")
+        return None
+
+    def put(self, key: str, data: bytes):
+        if not self.enabled:
+            return
+        self._remember(key, time.time(), data)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Scrittura atomica: le richieste concorrenti non leggono mai file parziali
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            logger.warning("Errore nel salvataggio dello screenshot in cache: %s", e)
+            return
+        self.count("stores")
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += len(data)
+            over_limit = self._disk_bytes is None or self._disk_bytes > self.max_disk_bytes
+        if over_limit:
+            self._evict_disk()
+
+    def _remember(self, key: str, stored_at: float, data: bytes):
+        with self._lock:
+            self._memory[key] = (stored_at, data)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_items:
+                self._memory.popitem(last=False)
+
+    def _evict_disk(self):
+        """Elimina i file scaduti e poi i piu' vecchi finche' la cache su disco rientra nel limite."""
+        try:
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(".img"):
+                    continue
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        except OSError:
+            return
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        evicted = 0
+        for mtime, size, path in entries:
+            if total <= self.max_disk_bytes and now - mtime <= self.ttl:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+                evicted += 1
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_bytes = total
+            self.counters["evictions"] += evicted
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"enabled": self.enabled, "memory_items": len(self._memory),
+                    "disk_bytes": self._disk_bytes, **self.counters}
+
+screenshot_cache = ScreenshotCache(SCREENSHOT_CACHE_DIR, SCREENSHOT_CACHE_TTL,
+                                   SCREENSHOT_CACHE_MEMORY_ITEMS, SCREENSHOT_CACHE_MAX_BYTES)
+
+class ScreenshotProvider(ABC):
+    """
+    Interfaccia dei servizi di screenshot: capture() restituisce i bytes
+    dell'immagine (PNG/JPEG) della pagina indicata.
+    """
+    name = "base"
+
+    @abstractmethod
+    def capture(self, link: str, width: int, height: int, delay: int) -> bytes:
+        """Bytes dell'immagine della pagina link, larga width x height pixel, dopo delay ms."""
+
+class HttpScreenshotProvider(ScreenshotProvider):
+    """
+    Servizio HTTP (pikwy): sessione con pool di connessioni e nuovi tentativi
+    con backoff esponenziale su errori di rete, 429 e 5xx.
+    """
+    name = "pikwy"
+
+    def __init__(self, base_url: str, token: str, timeout: float, retries: int, backoff: float, pool_size: int):
+        self.base_url = base_url
+        self.token = token
+        self.timeout = timeout
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=("GET",), raise_on_status=False)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def capture(self, link: str, width: int, height: int, delay: int) -> bytes:
+        params = {"token": self.token, "url": link, "width": width, "height": height, "delay": delay}
+        response = self.session.get(self.base_url, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return response.content
+
+class StubScreenshotProvider(ScreenshotProvider):
+    """
+    Provider locale per test e benchmark offline: restituisce le immagini della
+    cartella fixture_dir (scelte in base al link) oppure un'immagine generata,
+    dopo una latenza di latency secondi piu' un jitter casuale fino a jitter.
+    """
+    name = "stub"
+
+    def __init__(self, fixture_dir: str, latency: float, jitter: float):
+        self.latency = latency
+        self.jitter = jitter
+        self.fixtures = []
+        if fixture_dir and os.path.isdir(fixture_dir):
+            for filename in sorted(os.listdir(fixture_dir)):
+                if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
+                    with open(os.path.join(fixture_dir, filename), 'rb') as f:
+                        self.fixtures.append(f.read())
+
+    def capture(self, link: str, width: int, height: int, delay: int) -> bytes:
+        time.sleep(self.latency + random.uniform(0, self.jitter))
+        digest = hashlib.md5(link.encode('utf-8')).digest()
+        if self.fixtures:
+            return self.fixtures[digest[0] % len(self.fixtures)]
+        img_buffer = io.BytesIO()
+        Image.new('RGB', (width, height), tuple(digest[:3])).save(img_buffer, format='PNG')
+        return img_buffer.getvalue()
+
+def create_screenshot_provider(name: str) -> ScreenshotProvider:
+    """Crea il provider di screenshot configurato (SCREENSHOT_PROVIDER)."""
+    if name == "stub":
+        return StubScreenshotProvider(os.getenv("SCREENSHOT_STUB_DIR", ""),
+                                      float(os.getenv("SCREENSHOT_STUB_LATENCY", "0")),
+                                      float(os.getenv("SCREENSHOT_STUB_JITTER", "0")))
+    if name == "pikwy":
+        return HttpScreenshotProvider(os.getenv("PIKWY_URL", "https://api.pikwy.com/"),
+                                      os.getenv("PIKWY_TOKEN", "d986f1a6c33f7e186706833bdca6598d55c7c32382a20c6f"),
+                                      SCREENSHOT_TIMEOUT,
+                                      int(os.getenv("SCREENSHOT_RETRIES", "2")),
+                                      float(os.getenv("SCREENSHOT_BACKOFF", "1.0")),
+                                      SCREENSHOT_MAX_PARALLEL)
+    raise ValueError(f"Provider di screenshot sconosciuto: {name}")
+
+screenshot_provider = create_screenshot_provider(os.getenv("SCREENSHOT_PROVIDER", "pikwy"))
+
+def fetch_screenshot(link: str, cache_mode: str = "use") -> bytes:
+    """
+    Cattura lo screenshot del link tramite il provider configurato e restituisce i bytes dell'immagine.
+    La cache viene consultata con cache_mode "use", solo aggiornata con "refresh"
+    e ignorata del tutto con "bypass". Se il provider non restituisce un'immagine
+    (es. una pagina di errore HTML con stato 200) solleva ValueError e non salva nulla.
+    """
+    decoded_link = unquote(link)
+    cache_key = ScreenshotCache.key(decoded_link, SCREENSHOT_WIDTH, SCREENSHOT_HEIGHT,
+                                    SCREENSHOT_DELAY, screenshot_provider.name)
+    if cache_mode == "use":
+        cached = screenshot_cache.get(cache_key)
+        # Voci non valide salvate da versioni precedenti vengono ignorate e riscritte
+        if cached is not None and sniff_image_format(cached[:SNIFF_BYTES]):
+            logger.debug("Screenshot da cache: %s (%d bytes)", decoded_link, len(cached))
+            return cached
+    else:
+        screenshot_cache.count("bypassed")
+    
+    logger.info("Catturando screenshot da: %s (provider %s)", decoded_link, screenshot_provider.name)
+    fetch_started = time.perf_counter()
+    screenshot_bytes = screenshot_provider.capture(decoded_link, SCREENSHOT_WIDTH, SCREENSHOT_HEIGHT, SCREENSHOT_DELAY)
+    STAGE_SECONDS.labels("screenshot_fetch").observe(time.perf_counter() - fetch_started)
+    logger.debug("Screenshot catturato: %d bytes", len(screenshot_bytes))
+    if not sniff_image_format(screenshot_bytes[:SNIFF_BYTES]):
+        raise ValueError(f"Il provider non ha restituito un'immagine per {decoded_link} "
+                         f"({len(screenshot_bytes)} bytes: {screenshot_bytes[:40]!r})")
+    
+    if cache_mode != "bypass":
+        screenshot_cache.put(cache_key, screenshot_bytes)
+    return screenshot_bytes
+
+def start_screenshot_fetches(links: List[str], cache_mode: str = "use") -> list:
+    """Avvia in parallelo la cattura degli screenshot; restituisce i future nell'ordine dei link."""
+    return [screenshot_executor.submit(fetch_screenshot, single_link, cache_mode) for single_link in links]
+
+def collect_screenshots(links: List[str], futures: list, cancel_on_timeout: bool = True):
+    """
+    Restituisce, nell'ordine dei link, le coppie (link, screenshot) avviate con
+    start_screenshot_fetches, attendendo ciascuna entro SCREENSHOT_TIMEOUT dalla
+    prima attesa. I link falliti o scaduti hanno screenshot None.
+    Con cancel_on_timeout=False gli screenshot scaduti non vengono annullati:
+    serve quando gli stessi future sono attesi anche da altri report (batch).
+    """
+    deadline = None
+    for single_link, future in zip(links, futures):
+        if deadline is None:
+            deadline = time.monotonic() + SCREENSHOT_TIMEOUT
+        try:
+            yield single_link, future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except FuturesTimeoutError:
+            if cancel_on_timeout:
+                future.cancel()
+            logger.error("Timeout dello screenshot per il link %s", single_link)
+            FAILURES.labels("screenshot").inc()
+            yield single_link, None
+        except Exception as e:
+            logger.error("Errore nella cattura dello screenshot per il link %s: %s", single_link, e)
+            FAILURES.labels("screenshot").inc()
+            yield single_link, None
+
+def fetch_screenshots(links: List[str]) -> List[Optional[bytes]]:
+    """Scarica gli screenshot di tutti i link in parallelo, nell'ordine dei link."""
+    return [screenshot for _, screenshot in collect_screenshots(links, start_screenshot_fetches(links))]
+
+def screenshot_area(page_width: float, page_height: float, header_logo_height_pt: float = 0,
+                    margin: float = 50) -> Tuple[float, float, float]:
+    """Larghezza e altezza massime dello screenshot e margine inferiore (sopra il link)."""
+    logo_space_height = header_logo_height_pt + 15 if header_logo_height_pt else 0
+    link_space_height = 2
+    margin_top = margin + logo_space_height
+    margin_bottom = margin + link_space_height
+    return page_width - 2 * margin, page_height - margin_top - margin_bottom, margin_bottom
+
+def prepare_screenshot(link: str, screenshot_bytes: bytes, header_logo_height_pt: float = 0,
+                       target_dpi: int = 0, profile: Optional[OutputProfile] = None,
+                       pagesize: Tuple[float, float] = A4) -> PreparedImage:
+    """Prepara lo screenshot per il riquadro della pagina (vedi screenshot_area)."""
+    max_width, max_height, _ = screenshot_area(*pagesize, header_logo_height_pt)
+    # Lo screenshot resta senza perdita (Flate), come il PNG usato in precedenza,
+    # salvo i profili che convertono tutto in JPEG
+    return prepare_image(f"screenshot {unquote(link)}", screenshot_bytes, max_width, max_height,
+                         target_dpi, lossless=True, profile=profile)
+
+def draw_screenshot_page(c: canvas.Canvas, link: str, screenshot: Union[bytes, PreparedImage],
+                         header_logo_height_pt: float = 0, target_dpi: int = 0,
+                         profile: Optional[OutputProfile] = None) -> bool:
+    """
+    Disegna sulla pagina corrente del canvas lo screenshot del link, con il logo
+    di intestazione e il link cliccabile. Il testo del link mostra solo il dominio,
+    ma punta all'URL completo. Restituisce False se lo screenshot non e' utilizzabile.
+    screenshot puo' essere gia' preparato con prepare_screenshot (stesso logo e pagina).
+    """
+    decoded_link = unquote(link)
+    page_width, page_height = c._pagesize
+    margin = 50
+    max_width, max_height, margin_bottom = screenshot_area(page_width, page_height, header_logo_height_pt, margin)
+    
+    if isinstance(screenshot, PreparedImage):
+        prepared = screenshot
+    else:
+        prepared = prepare_screenshot(link, screenshot, header_logo_height_pt, target_dpi, profile, c._pagesize)
+    if prepared.error:
+        logger.error("Errore nell'aggiunta dello screenshot per il link %s: %s", link, prepared.error)
+        return False
+    
+    x = (page_width - prepared.scaled_width) / 2
+    y = margin_bottom + (max_height - prepared.scaled_height) / 2
+    
+    embed_image_stream(c, prepared.name, prepared.width, prepared.height,
+                       prepared.color_space, prepared.filters, prepared.stream)
+    draw_image_stream(c, prepared.name, x, y, prepared.scaled_width, prepared.scaled_height)
+    
+    if header_logo_height_pt:
+        c.doForm(LOGO_HEADER_FORM)
+        logger.debug("Logo aggiunto alla pagina screenshot")
+    
+    # --- SEZIONE MODIFICATA PER IL LINK CLICCABILE ---
+    
+    font_name = "Helvetica"
+    font_size = 10
+    
+    # MODIFICA: Estrai lo schema e il dominio per creare il link "pulito" da visualizzare.
     try:
-        decoded_link = unquote(link)
-        print(f"Link ricevuto: {link}")
-        print(f"Link decodificato: {decoded_link}")
-
-        # Scarica il logo
-        logo_bytes = download_logo()
-        logo_image = None
-        if logo_bytes:
+        parsed_url = urlparse(decoded_link)
+        # Ricostruisci il link pulito (es. https://www.dominio.com)
+        clean_link_text = f"{parsed_url.scheme}://{parsed_url.netloc}"
+    except Exception:
+        # Se l'URL non è valido, usa comunque il link completo come testo
+        clean_link_text = decoded_link
+    
+    c.setFont(font_name, font_size)
+    
+    # Usa il testo pulito per calcolare la larghezza e la posizione
+    link_width = c.stringWidth(clean_link_text, font_name, font_size)
+    link_x = (page_width - link_width) / 2
+    link_y = margin / 2
+    
+    # Disegna il testo "pulito" in blu per farlo sembrare un link
+    c.setFillColorRGB(0, 0, 1)
+    c.drawString(link_x, link_y, clean_link_text)
+    
+    # Crea l'area cliccabile (hotspot) sull'area del testo pulito
+    rect = [link_x, link_y, link_x + link_width, link_y + font_size]
+    
+    # MODIFICA FONDAMENTALE: L'hotspot punta al link COMPLETO e originale
+    c.linkURL(decoded_link, rect, relative=1)
+    
+    logger.debug("Link cliccabile aggiunto: testo=%r, destinazione=%r", clean_link_text, decoded_link)
+    
+    # --- FINE SEZIONE MODIFICATA ---
+    return True
+
+def draw_screenshot_pages(c: canvas.Canvas,
+                          screenshots: Optional[Iterable[Tuple[str, Optional[Union[bytes, PreparedImage]]]]],
+                          logo: Optional[LogoAsset], target_dpi: int = 0,
+                          on_link: Optional[Callable[[int], None]] = None,
+                          profile: Optional[OutputProfile] = None) -> int:
+    """
+    Aggiunge al canvas una pagina per ogni coppia (link, screenshot), nell'ordine
+    ricevuto; lo screenshot sono i bytes dell'immagine oppure un PreparedImage.
+    Gli screenshot mancanti (None) vengono saltati. Restituisce le pagine aggiunte.
+    on_link riceve il numero di link elaborati finora.
+    """
+    pages = 0
+    for i, (single_link, screenshot_bytes) in enumerate(screenshots or ()):
+        logger.debug("Elaborazione link %d: %s", i + 1, single_link)
+        if screenshot_bytes is None:
+            logger.warning("Screenshot non disponibile, pagina saltata: %s", single_link)
+            if on_link:
+                on_link(i + 1)
+            continue
+        
+        header_logo_height_pt = 0
+        if logo:
             try:
-                logo_image = Image.open(io.BytesIO(logo_bytes))
-                if logo_image.mode in ('RGBA', 'LA', 'P'):
-                    background = Image.new('RGB', logo_image.size, (255, 255, 255))
-                    if logo_image.mode == 'P':
-                        logo_image = logo_image.convert('RGBA')
-                    background.paste(logo_image, mask=logo_image.split()[-1] if logo_image.mode in ('RGBA', 'LA') else None)
-                    logo_image = background
-                elif logo_image.mode != 'RGB':
-                    logo_image = logo_image.convert('RGB')
+                header_logo_height_pt = register_logo_header(c, logo)
             except Exception as e:
-                print(f"Errore nella preparazione del logo: {e}")
-                logo_image = None
+                logger.error("Errore nella registrazione del logo di intestazione: %s", e)
         
+        if draw_screenshot_page(c, single_link, screenshot_bytes, header_logo_height_pt, target_dpi, profile):
+            c.showPage()
+            pages += 1
+        if on_link:
+            on_link(i + 1)
+    return pages
+
+def add_screenshot_to_pdf(pdf_bytes: bytes, link: str, screenshot_bytes: Optional[bytes] = None) -> bytes:
+    """
+    Aggiunge una pagina con screenshot del link a un PDF gia' esistente.
+    Se screenshot_bytes non e' indicato, lo screenshot viene scaricato ora.
+    Rilegge e riscrive l'intero documento: per generare un report con piu' link
+    conviene passare gli screenshot a create_pdf_from_images.
+    """
+    try:
+        logger.debug("Link ricevuto: %s (decodificato: %s)", link, unquote(link))
+
         # Cattura screenshot del sito
-        screenshot_url = f"https://api.pikwy.com/?token=d986f1a6c33f7e186706833bdca6598d55c7c32382a20c6f&url={decoded_link}&width=960&height=1300&delay=6000"
-        print(f"Catturando screenshot da: {decoded_link}")
-        
-        screenshot_response = requests.get(screenshot_url, timeout=60)
-        screenshot_response.raise_for_status()
-        screenshot_bytes = screenshot_response.content
-        print(f"Screenshot catturato: {len(screenshot_bytes)} bytes")
-        
-        screenshot_image = Image.open(io.BytesIO(screenshot_bytes))
-        if screenshot_image.mode in ('RGBA', 'LA', 'P'):
-            background = Image.new('RGB', screenshot_image.size, (255, 255, 255))
-            if screenshot_image.mode == 'P':
-                screenshot_image = screenshot_image.convert('RGBA')
-            background.paste(screenshot_image, mask=screenshot_image.split()[-1] if screenshot_image.mode in ('RGBA', 'LA') else None)
-            screenshot_image = background
-        elif screenshot_image.mode != 'RGB':
-            screenshot_image = screenshot_image.convert('RGB')
+        if screenshot_bytes is None:
+            screenshot_bytes = fetch_screenshot(link)
         
         # Crea una nuova pagina PDF con lo screenshot
         new_page_buffer = io.BytesIO()
         c = canvas.Canvas(new_page_buffer, pagesize=A4)
-        page_width, page_height = A4
-        
-        img_width, img_height = screenshot_image.size
-        
-        logo_space_height = 0
-        link_space_height = 2
-        
-        if logo_image:
-            logo_width_px = 120
-            logo_width_pt = logo_width_px * 0.75
-            logo_original_width, logo_original_height = logo_image.size
-            logo_height_pt = (logo_original_height / logo_original_width) * logo_width_pt
-            logo_space_height = logo_height_pt + 15
-        
-        margin = 50
-        margin_top = margin + logo_space_height
-        margin_bottom = margin + link_space_height
-        max_width = page_width - 2 * margin
-        max_height = page_height - margin_top - margin_bottom
-        
-        scale_x = max_width / img_width
-        scale_y = max_height / img_height
-        scale = min(scale_x, scale_y)
-        
-        scaled_width = img_width * scale
-        scaled_height = img_height * scale
-        
-        x = (page_width - scaled_width) / 2
-        y = margin_bottom + (max_height - scaled_height) / 2
-        
-        screenshot_buffer = io.BytesIO()
-        screenshot_image.save(screenshot_buffer, format='PNG')
-        screenshot_buffer.seek(0)
-        
-        c.drawImage(ImageReader(screenshot_buffer), x, y, scaled_width, scaled_height)
-        
-        if logo_image:
-            try:
-                logo_buffer = io.BytesIO()
-                logo_image.save(logo_buffer, format='PNG')
-                logo_buffer.seek(0)
-                
-                logo_x = margin
-                logo_y = page_height - margin - logo_height_pt
-                
-                c.drawImage(ImageReader(logo_buffer), logo_x, logo_y, logo_width_pt, logo_height_pt)
-                print("Logo aggiunto alla pagina screenshot")
-            except Exception as e:
-                print(f"Errore nell'aggiunta del logo: {e}")
-        
-        # --- SEZIONE MODIFICATA PER IL LINK CLICCABILE ---
-        
-        font_name = "Helvetica"
-        font_size = 10
-        
-        # MODIFICA: Estrai lo schema e il dominio per creare il link "pulito" da visualizzare.
-        try:
-            parsed_url = urlparse(decoded_link)
-            # Ricostruisci il link pulito (es. https://www.dominio.com)
-            clean_link_text = f"{parsed_url.scheme}://{parsed_url.netloc}"
-        except Exception:
-            # Se l'URL non è valido, usa comunque il link completo come testo
-            clean_link_text = decoded_link
-        
-        c.setFont(font_name, font_size)
-        
-        # Usa il testo pulito per calcolare la larghezza e la posizione
-        link_width = c.stringWidth(clean_link_text, font_name, font_size)
-        link_x = (page_width - link_width) / 2
-        link_y = margin / 2
-        
-        # Disegna il testo "pulito" in blu per farlo sembrare un link
-        c.setFillColorRGB(0, 0, 1)
-        c.drawString(link_x, link_y, clean_link_text)
-        
-        # Crea l'area cliccabile (hotspot) sull'area del testo pulito
-        rect = [link_x, link_y, link_x + link_width, link_y + font_size]
-        
-        # MODIFICA FONDAMENTALE: L'hotspot punta al link COMPLETO e originale
-        c.linkURL(decoded_link, rect, relative=1)
-        
-        print(f"Link cliccabile aggiunto: Testo='{clean_link_text}', Destinazione='{decoded_link}'")
-        
-        # --- FINE SEZIONE MODIFICATA ---
-        
+        if not draw_screenshot_pages(c, [(link, screenshot_bytes)], logo_cache.get()):
+            return pdf_bytes
         c.save()
         new_page_buffer.seek(0)
         
         # Combina il PDF esistente con la nuova pagina
+        merge_started = time.perf_counter()
         existing_pdf = PdfReader(io.BytesIO(pdf_bytes))
         new_page_pdf = PdfReader(new_page_buffer)
         
@@ -411,70 +1404,878 @@ def add_screenshot_to_pdf(pdf_bytes: bytes, link: str) -> bytes:
         final_pdf_buffer.seek(0)
         
         final_pdf_bytes = final_pdf_buffer.getvalue()
-        print(f"PDF finale creato con {len(existing_pdf.pages) + 1} pagine, dimensione: {len(final_pdf_bytes)} bytes")
+        STAGE_SECONDS.labels("merge").observe(time.perf_counter() - merge_started)
+        logger.info("PDF finale creato con %d pagine, dimensione: %d bytes", len(existing_pdf.pages) + 1, len(final_pdf_bytes))
         
         return final_pdf_bytes
         
     except Exception as e:
-        print(f"ERRORE nell'aggiunta dello screenshot per il link {link}: {e}")
+        logger.error("Errore nell'aggiunta dello screenshot per il link %s: %s", link, e)
         # Restituisce il PDF originale in caso di errore
         return pdf_bytes
 
+def render_report(zip_binary_data: Union[bytes, BinaryIO], links: List[str], options: RenderOptions,
+                  output: BinaryIO, stats: Optional[Dict[str, Any]] = None,
+                  progress: Optional[Callable[[int, int], None]] = None):
+    """
+    Pipeline completa e sincrona: PDF dalle immagini dello ZIP piu' una pagina
+    di screenshot per ogni link, scritto nel file output. Va eseguita fuori
+    dall'event loop. progress riceve (pagine completate, pagine totali).
+    """
+    # Gli screenshot vengono scaricati in parallelo mentre si creano le pagine delle immagini
+    screenshot_futures = start_screenshot_fetches(links, options.screenshot_cache)
+    if links:
+        logger.info("Trovati %d link nell'header: %s", len(links), links)
+    else:
+        logger.debug("Nessun header 'link' trovato: nessuno screenshot")
+    
+    # Immagini e screenshot sullo stesso canvas: il PDF viene scritto una sola volta
+    logger.info("Creazione PDF, profilo %s, risoluzione immagini: %s DPI", options.profile,
+                options.target_dpi or "originale")
+    create_pdf_from_images(zip_binary_data, options, stats,
+                           collect_screenshots(links, screenshot_futures), output,
+                           progress, len(links))
+
+# Report di un batch generati in parallelo e numero massimo di report per batch
+BATCH_WORKERS = int(os.getenv("PDF_BATCH_WORKERS", "4"))
+BATCH_MAX_REPORTS = int(os.getenv("PDF_BATCH_MAX_REPORTS", "100"))
+
+class BatchReport(BaseModel):
+    """
+    Report di un batch: nome del PDF, immagini dello ZIP (nomi o pattern, vuoto = tutte),
+    link e titolo della copertina (vuoto = quello della richiesta).
+    """
+    name: str = ""
+    images: List[str] = []
+    links: List[str] = []
+    title: str = ""
+
+class BatchManifest(BaseModel):
+    reports: List[BatchReport]
+
+def match_images(patterns: List[str], image_files: List[str]) -> List[str]:
+    """Immagini dello ZIP corrispondenti ai nomi o ai pattern (es. 'cliente1/*'); nessun pattern = tutte."""
+    if not patterns:
+        return list(image_files)
+    return [f for f in image_files if any(f == p or fnmatch.fnmatchcase(f, p) for p in patterns)]
+
+def batch_file_names(manifest: BatchManifest) -> List[str]:
+    """Nomi univoci e senza percorso dei PDF nello ZIP di uscita."""
+    names = []
+    used = set()
+    for i, report in enumerate(manifest.reports):
+        base = os.path.basename(report.name.replace("\\", "/")).strip()
+        if base.lower().endswith(".pdf"):
+            base = base[:-4]
+        base = base or f"report_{i + 1}"
+        name = f"{base}.pdf"
+        suffix = 2
+        while name in used:
+            name = f"{base}_{suffix}.pdf"
+            suffix += 1
+        used.add(name)
+        names.append(name)
+    return names
+
+def render_batch(zip_file: BinaryIO, manifest: BatchManifest, options: RenderOptions,
+                 output: BinaryIO, stats: Optional[Dict[str, Any]] = None):
+    """
+    Genera i report del manifest dallo stesso ZIP e scrive in output uno ZIP di PDF,
+    nell'ordine del manifest. Il lavoro comune viene fatto una volta sola: le
+    immagini usate da piu' report vengono preparate prima e condivise, ogni link
+    viene scaricato e preparato una volta anche se compare in piu' report, il logo
+    arriva gia' decodificato dalla cache di processo. I report girano su BATCH_WORKERS thread.
+    """
+    if stats is None:
+        stats = {}
+    logo = logo_cache.get()
+    header_logo_height_pt = logo.height_for_width(HEADER_LOGO_WIDTH_PT) if logo else 0
+    max_width, max_height, _ = image_area(*A4, header_logo_height_pt)
+    profile = options.output_profile()
+    
+    links = list(dict.fromkeys(single_link for report in manifest.reports for single_link in report.links))
+    
+    def fetch_prepared(single_link: str) -> PreparedImage:
+        # Scaricato e preparato una volta sola, poi disegnato in ogni report che lo usa
+        return prepare_screenshot(single_link, fetch_screenshot(single_link, options.screenshot_cache),
+                                  header_logo_height_pt, options.target_dpi, profile)
+    
+    # Gli screenshot partono subito, mentre si copia lo ZIP e si preparano le immagini condivise
+    link_futures = {single_link: screenshot_executor.submit(fetch_prepared, single_link) for single_link in links}
+    # Ogni report apre lo ZIP con un proprio handle: serve una copia su file
+    fd, zip_path = tempfile.mkstemp(suffix=".zip")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            zip_file.seek(0)
+            shutil.copyfileobj(zip_file, f)
+            stats["input_bytes"] = f.tell()
+        
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            image_files, image_formats = select_image_entries(zip_ref)
+            report_images = [match_images(report.images, image_files) for report in manifest.reports]
+            usage = Counter(f for images in report_images for f in set(images))
+            shared_names = sorted(f for f, count in usage.items() if count > 1)
+            logger.info("Batch: %d report, %d immagini condivise", len(manifest.reports), len(shared_names))
+            shared_images = {prepared.filename: prepared for prepared in
+                             prepare_images(zip_ref, shared_names, max_width, max_height,
+                                            options.target_dpi, image_formats,
+                                            profile=profile, dedupe=False)}
+        
+        stats.update(reports=len(manifest.reports), shared_images=len(shared_names), screenshot_links=len(links))
+        
+        def render_one(report: BatchReport, images: List[str]):
+            pdf_file = tempfile.TemporaryFile()
+            title = clean_cover_title(report.title)
+            report_options = options.model_copy(update={"cover_title": title}) if title else options
+            with open(zip_path, "rb") as report_zip:
+                create_pdf_from_images(report_zip, report_options, None,
+                                       # Un report scaduto non deve annullare gli screenshot degli altri
+                                       collect_screenshots(report.links, [link_futures[l] for l in report.links],
+                                                           cancel_on_timeout=False),
+                                       pdf_file, None, len(report.links), images, shared_images)
+            return pdf_file
+        
+        with ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="pdf-batch") as executor, \
+                zipfile.ZipFile(output, 'w', zipfile.ZIP_STORED) as out_zip:
+            report_futures = [executor.submit(render_one, report, images)
+                              for report, images in zip(manifest.reports, report_images)]
+            # I PDF sono gia' compressi: nello ZIP vengono solo archiviati
+            for name, future in zip(batch_file_names(manifest), report_futures):
+                with future.result() as pdf_file:
+                    pdf_file.seek(0)
+                    with out_zip.open(name, 'w', force_zip64=True) as entry:
+                        shutil.copyfileobj(pdf_file, entry)
+                logger.debug("Report %s aggiunto al batch", name)
+        stats["output_bytes"] = output.tell()
+    finally:
+        # Batch interrotto: gli screenshot non ancora avviati non servono piu'
+        for future in link_futures.values():
+            future.cancel()
+        os.remove(zip_path)
+
+# Numero massimo di PDF generati contemporaneamente da un worker
+MAX_CONCURRENT_RENDERS = int(os.getenv("PDF_MAX_CONCURRENT_RENDERS", "4"))
+render_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_RENDERS, thread_name_prefix="pdf-render")
+render_semaphore = asyncio.Semaphore(MAX_CONCURRENT_RENDERS)
+render_metrics = {"queued": 0, "in_flight": 0, "completed": 0, "failed": 0, "max_queued": 0}
+
+async def wait_until_done(future: asyncio.Future) -> bool:
+    """
+    Attende la fine di future anche se il chiamante viene annullato nel frattempo.
+    Restituisce True se c'e' stato un annullamento (da rilanciare o gestire).
+    """
+    cancelled = False
+    while not future.done():
+        try:
+            await asyncio.wait([future])
+        except asyncio.CancelledError:
+            cancelled = True
+    return cancelled
+
+async def run_render(func, *args):
+    """
+    Esegue func sul pool di rendering, con al massimo MAX_CONCURRENT_RENDERS
+    esecuzioni attive; le altre richieste attendono in coda (vedi /stats).
+    Il thread non si puo' interrompere: se la richiesta viene annullata durante
+    il rendering, la coroutine termina (con CancelledError) solo quando il thread
+    ha finito, cosi' il posto nel pool e i file usati restano validi fino ad allora.
+    """
+    render_metrics["queued"] += 1
+    render_metrics["max_queued"] = max(render_metrics["max_queued"], render_metrics["queued"])
+    try:
+        await render_semaphore.acquire()
+    finally:
+        render_metrics["queued"] -= 1
+    
+    render_metrics["in_flight"] += 1
+    try:
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(render_executor, functools.partial(func, *args))
+        try:
+            result = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            await wait_until_done(future)
+            raise
+        render_metrics["completed"] += 1
+        return result
+    except Exception:
+        render_metrics["failed"] += 1
+        FAILURES.labels("request").inc()
+        raise
+    finally:
+        render_metrics["in_flight"] -= 1
+        render_semaphore.release()
+
+# Rendering "grandi": ZIP oltre LARGE_RENDER_BYTES. Ogni worker ne accetta al massimo
+# MAX_LARGE_RENDERS insieme, le altre richieste ricevono 503 (0 = nessun limite)
+LARGE_RENDER_BYTES = int(os.getenv("PDF_LARGE_RENDER_BYTES", str(20 * 1024 * 1024)))
+MAX_LARGE_RENDERS = int(os.getenv("PDF_MAX_LARGE_RENDERS", "2"))
+# Secondi suggeriti al client nell'header Retry-After delle risposte 503
+RETRY_AFTER_SECONDS = int(os.getenv("PDF_RETRY_AFTER", "30"))
+# Oltre questa memoria residente il worker si riavvia dopo il rendering in corso
+# (0 = disattivato: serve un gestore come gunicorn che avvii il sostituto)
+WORKER_MAX_RSS_MB = int(os.getenv("PDF_WORKER_MAX_RSS_MB", "0"))
+
+def current_rss_mb() -> float:
+    """Memoria residente attuale del processo in MB (da /proc, altrimenti il picco)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class RenderAdmission:
+    """
+    Ammissione dei rendering nel worker: limita quelli grandi in corso e, durante
+    lo spegnimento (draining), rifiuta i nuovi mentre quelli avviati terminano.
+    Dopo ogni rendering controlla la memoria e, oltre max_rss_mb, chiede un
+    riavvio ordinato del worker (SIGTERM a se stesso: gunicorn ne avvia un altro).
+    """
+    def __init__(self, large_bytes: int, max_large: int, max_rss_mb: int):
+        self.large_bytes = large_bytes
+        self.max_large = max_large
+        self.max_rss_mb = max_rss_mb
+        self.large_in_flight = 0
+        self.draining = False
+        self.admitted = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+    
+    def is_large(self, input_bytes: int) -> bool:
+        return self.max_large > 0 and input_bytes >= self.large_bytes
+    
+    def acquire(self, input_bytes: int) -> Optional[str]:
+        """Riserva il posto per un rendering: None se ammesso, altrimenti il motivo del rifiuto."""
+        with self._lock:
+            if self.draining:
+                reason = "Server in riavvio, riprovare piu' tardi"
+            elif self.is_large(input_bytes) and self.large_in_flight >= self.max_large:
+                reason = "Troppi PDF di grandi dimensioni in lavorazione, riprovare piu' tardi"
+            else:
+                self.large_in_flight += int(self.is_large(input_bytes))
+                self.admitted += 1
+                return None
+            self.rejected += 1
+        FAILURES.labels("admission").inc()
+        logger.warning("Rendering rifiutato (%d bytes): %s", input_bytes, reason)
+        return reason
+    
+    def release(self, input_bytes: int):
+        """Libera il posto riservato da acquire e controlla la memoria del worker."""
+        with self._lock:
+            self.large_in_flight -= int(self.is_large(input_bytes))
+        self.recycle_if_needed()
+    
+    def recycle_if_needed(self):
+        if self.max_rss_mb <= 0 or self.draining:
+            return
+        rss = current_rss_mb()
+        if rss < self.max_rss_mb:
+            return
+        logger.warning("Memoria del worker %.0f MB oltre il limite di %d MB: riavvio ordinato", rss, self.max_rss_mb)
+        self.draining = True
+        os.kill(os.getpid(), signal.SIGTERM)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {"large_in_flight": self.large_in_flight, "max_large_renders": self.max_large,
+                "large_render_bytes": self.large_bytes, "admitted": self.admitted,
+                "rejected": self.rejected, "draining": self.draining,
+                "rss_mb": round(current_rss_mb(), 1), "max_rss_mb": self.max_rss_mb}
+
+admission = RenderAdmission(LARGE_RENDER_BYTES, MAX_LARGE_RENDERS, WORKER_MAX_RSS_MB)
+
+def service_unavailable(message: str, timestamp: str) -> Response:
+    """Risposta 503 con Retry-After, per code piene e rendering non ammessi."""
+    return Response(
+        content=json.dumps({"status": "error", "message": message, "timestamp": timestamp}),
+        status_code=503,
+        media_type="application/json",
+        headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+    )
+
+# Cache dei PDF generati, indirizzata dal contenuto della richiesta (0 byte = disattivata)
+OUTPUT_CACHE_DIR = os.getenv("PDF_OUTPUT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "dpsonline_pdf_cache"))
+OUTPUT_CACHE_MAX_BYTES = int(os.getenv("PDF_OUTPUT_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+OUTPUT_CACHE_TTL = int(os.getenv("PDF_OUTPUT_CACHE_TTL", "21600"))
+# Da incrementare quando cambia il rendering, per non servire PDF prodotti dal codice precedente
+OUTPUT_CACHE_FORMAT = 1
+HASH_CHUNK_SIZE = 1024 * 1024
+
+class OutputCache:
+    """
+    Cache su disco dei PDF di /genera_pdf. La chiave e' lo SHA-256 di ZIP, link,
+    opzioni di rendering, data e versione del logo, e fa anche da ETag. Ogni PDF
+    vale solo nel giorno in cui e' stato generato (la copertina riporta la data)
+    e al massimo ttl secondi (gli screenshot invecchiano); oltre max_bytes si
+    eliminano i piu' vecchi.
+    """
+    def __init__(self, directory: str, max_bytes: int, ttl: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._disk_bytes: Optional[int] = None
+        self.counters = {"hits": 0, "misses": 0, "not_modified": 0, "stores": 0, "skipped": 0, "evictions": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0 and self.ttl > 0
+
+    def count(self, name: str):
+        with self._lock:
+            self.counters[name] += 1
+
+    @staticmethod
+    def key(zip_file: BinaryIO, links: List[str], options: RenderOptions) -> str:
+        """Hash della richiesta; legge lo ZIP a blocchi (va chiamata fuori dall'event loop)."""
+        logo = logo_cache.get()
+        digest = hashlib.sha256(json.dumps({
+            "format": OUTPUT_CACHE_FORMAT,
+            "date": date.today().isoformat(),
+            "logo": logo.version if logo else None,
+            "options": options.model_dump(),
+            "links": links,
+        }, sort_keys=True).encode('utf-8'))
+        zip_file.seek(0)
+        for chunk in iter(lambda: zip_file.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+        zip_file.seek(0)
+        return digest.hexdigest()
+
+    def _paths(self, key: str) -> Tuple[str, str]:
+        return os.path.join(self.directory, f"{key}.pdf"), os.path.join(self.directory, f"{key}.json")
+
+    def _is_fresh(self, mtime: float) -> bool:
+        return (time.time() - mtime <= self.ttl
+                and date.fromtimestamp(mtime) == date.today())
+
+    def get(self, key: str) -> Optional[Tuple[BinaryIO, Dict[str, Any]]]:
+        """PDF in cache gia' aperto (resta leggibile anche se poi viene eliminato) e statistiche."""
+        if not self.enabled:
+            return None
+        pdf_path, meta_path = self._paths(key)
+        try:
+            if self._is_fresh(os.path.getmtime(pdf_path)):
+                with open(meta_path) as f:
+                    meta = json.load(f)
+                pdf_file = open(pdf_path, 'rb')
+                self.count("hits")
+                return pdf_file, meta
+        except (OSError, ValueError):
+            pass
+        self.count("misses")
+        return None
+
+    def put(self, key: str, pdf_file: BinaryIO, stats: Dict[str, Any]):
+        """Copia il PDF generato in cache (scrittura atomica, poi eventuale pulizia)."""
+        if not self.enabled:
+            return
+        pdf_path, meta_path = self._paths(key)
+        meta = {name: stats[name] for name in ("input_bytes", "output_bytes", "images_input_bytes", "images_output_bytes")}
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_meta = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, 'w') as f:
+                json.dump(meta, f)
+            fd, tmp_pdf = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, 'wb') as f:
+                pdf_file.seek(0)
+                shutil.copyfileobj(pdf_file, f)
+            # Prima le statistiche: un PDF presente ha sempre il suo .json
+            os.replace(tmp_meta, meta_path)
+            os.replace(tmp_pdf, pdf_path)
+        except OSError as e:
+            logger.warning("Errore nel salvataggio del PDF in cache: %s", e)
+            return
+        self.count("stores")
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += stats["output_bytes"]
+            over_limit = self._disk_bytes is None or self._disk_bytes > self.max_bytes
+        if over_limit:
+            self._evict()
+
+    def _evict(self):
+        """Elimina i PDF di altri giorni o scaduti, poi i piu' vecchi finche' si rientra nel limite."""
+        try:
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(".pdf"):
+                    continue
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        except OSError:
+            return
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for mtime, size, path in entries:
+            if total <= self.max_bytes and self._is_fresh(mtime):
+                continue
+            try:
+                os.remove(path)
+                os.remove(path[:-4] + ".json")
+            except OSError:
+                pass
+            total -= size
+            evicted += 1
+        with self._lock:
+            self._disk_bytes = total
+            self.counters["evictions"] += evicted
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"enabled": self.enabled, "disk_bytes": self._disk_bytes, **self.counters}
+
+output_cache = OutputCache(OUTPUT_CACHE_DIR, OUTPUT_CACHE_MAX_BYTES, OUTPUT_CACHE_TTL)
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Confronta l'header If-None-Match (lista di ETag, anche deboli) con etag.
+    '*' non e' supportato: il client deve indicare il PDF che possiede.
+    """
+    if not if_none_match:
+        return False
+    return any(value.strip().removeprefix("W/") == etag for value in if_none_match.split(","))
+
+# Job asincroni: worker dedicati, coda massima e conservazione dei PDF su disco
+JOB_WORKERS = int(os.getenv("PDF_JOB_WORKERS", "2"))
+JOB_MAX_QUEUED = int(os.getenv("PDF_JOB_MAX_QUEUED", "50"))
+JOB_RESULT_TTL = int(os.getenv("PDF_JOB_RESULT_TTL", "3600"))
+JOBS_DIR = os.getenv("PDF_JOBS_DIR", os.path.join(tempfile.gettempdir(), "dpsonline_jobs"))
+# Intervallo minimo in secondi tra due salvataggi dell'avanzamento di un job
+JOB_STATE_SAVE_INTERVAL = 1.0
+# Un job non concluso il cui stato non si aggiorna da questi secondi e' considerato
+# perso (worker terminato prima di completarlo) e viene riportato come fallito
+JOB_STALE_AFTER = int(os.getenv("PDF_JOB_STALE_AFTER", "900"))
+
+class Job:
+    """Stato di un job di generazione PDF; input e risultato restano su file in JOBS_DIR."""
+    def __init__(self, job_id: str, links: List[str], options: RenderOptions, timestamp: str):
+        self.id = job_id
+        self.links = links
+        self.options = options
+        self.timestamp = timestamp
+        self.status = "queued"
+        self.pages_done = 0
+        self.pages_total = 0
+        self.error: Optional[str] = None
+        self.stats: Dict[str, Any] = {}
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.input_path = ""
+        self.result_path = ""
+
+    def update_progress(self, pages_done: int, pages_total: int):
+        self.pages_done = pages_done
+        self.pages_total = pages_total
+
+    def state(self) -> Dict[str, Any]:
+        """Stato serializzabile, letto dagli altri worker che condividono JOBS_DIR."""
+        return {
+            "id": self.id, "timestamp": self.timestamp, "status": self.status,
+            "pages_done": self.pages_done, "pages_total": self.pages_total, "error": self.error,
+            "created_at": self.created_at, "finished_at": self.finished_at,
+            "stats": {name: self.stats[name] for name in
+                      ("output_bytes", "profile", "images_input_bytes", "images_output_bytes") if name in self.stats},
+        }
+
+    @classmethod
+    def from_state(cls, state: Dict[str, Any], directory: str) -> "Job":
+        job = cls(state["id"], [], RenderOptions(), state["timestamp"])
+        for name in ("status", "pages_done", "pages_total", "error", "created_at", "finished_at", "stats"):
+            setattr(job, name, state[name])
+        job.result_path = os.path.join(directory, f"{job.id}.pdf")
+        return job
+
+    def to_dict(self) -> Dict[str, Any]:
+        info = {
+            "job_id": self.id,
+            "status": self.status,
+            "pages_done": self.pages_done,
+            "pages_total": self.pages_total,
+            "created_at": datetime.fromtimestamp(self.created_at).isoformat(timespec="seconds"),
+        }
+        if self.finished_at:
+            info["finished_at"] = datetime.fromtimestamp(self.finished_at).isoformat(timespec="seconds")
+            info["expires_at"] = datetime.fromtimestamp(self.finished_at + JOB_RESULT_TTL).isoformat(timespec="seconds")
+        if self.status == "done":
+            info["output_bytes"] = self.stats.get("output_bytes", 0)
+            info["profile"] = self.stats.get("profile")
+            info["images_savings"] = size_savings(self.stats.get("images_input_bytes", 0),
+                                                  self.stats.get("images_output_bytes", 0))
+        if self.error:
+            info["error"] = self.error
+        return info
+
+class JobManager:
+    """
+    Esegue i job su un pool di JOB_WORKERS thread, separato da quello delle
+    richieste sincrone. Lo stato di ogni job e' salvato anche in JOBS_DIR
+    ({id}.json): con piu' worker (o dopo il riciclo di un worker) qualunque
+    processo che condivide la cartella puo' rispondere su stato e risultato.
+    I PDF completati restano su disco per JOB_RESULT_TTL secondi.
+    """
+    def __init__(self, directory: str, workers: int, max_queued: int, ttl: int):
+        self.directory = directory
+        self.max_queued = max_queued
+        self.ttl = ttl
+        self.jobs: Dict[str, Job] = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="pdf-job")
+        self.counters = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0, "expired": 0}
+        self._remove_stale_files()
+
+    def _remove_stale_files(self):
+        """Elimina i file lasciati da processi precedenti (i loro job non sono piu' raggiungibili)."""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and time.time() - entry.stat().st_mtime > self.ttl:
+                    os.remove(entry.path)
+        except OSError as e:
+            logger.warning("Errore nella pulizia della cartella dei job: %s", e)
+
+    def active_count(self) -> int:
+        with self.lock:
+            return sum(1 for job in self.jobs.values() if job.status in ("queued", "running"))
+
+    def submit(self, zip_file: BinaryIO, links: List[str], options: RenderOptions, timestamp: str) -> Optional[Job]:
+        """
+        Copia lo ZIP su disco e mette in coda il job. Restituisce None se la coda e' piena.
+        Va chiamata fuori dall'event loop (copia del file).
+        """
+        self.expire()
+        if self.active_count() >= self.max_queued:
+            self.counters["rejected"] += 1
+            return None
+        
+        job = Job(uuid.uuid4().hex, links, options, timestamp)
+        job.input_path = os.path.join(self.directory, f"{job.id}.zip")
+        job.result_path = os.path.join(self.directory, f"{job.id}.pdf")
+        os.makedirs(self.directory, exist_ok=True)
+        zip_file.seek(0)
+        with open(job.input_path, "wb") as f:
+            shutil.copyfileobj(zip_file, f)
+        
+        with self.lock:
+            self.jobs[job.id] = job
+        self.counters["submitted"] += 1
+        self._save(job)
+        self.executor.submit(self._run, job)
+        return job
+
+    def _run(self, job: Job):
+        job.status = "running"
+        self._save(job)
+        logger.info("Job %s avviato", job.id)
+        tmp_path = job.result_path + ".tmp"
+        last_saved = time.monotonic()
+        
+        def progress(pages_done: int, pages_total: int):
+            nonlocal last_saved
+            job.update_progress(pages_done, pages_total)
+            if time.monotonic() - last_saved >= JOB_STATE_SAVE_INTERVAL:
+                last_saved = time.monotonic()
+                self._save(job)
+        
+        try:
+            with open(job.input_path, "rb") as zip_file, open(tmp_path, "wb") as output:
+                render_report(zip_file, job.links, job.options, output, job.stats, progress)
+            REQUEST_SECONDS.labels("job").observe(time.time() - job.created_at)
+            os.replace(tmp_path, job.result_path)
+            job.status = "done"
+            self.counters["completed"] += 1
+            logger.info("Job %s completato: %d bytes", job.id, job.stats.get("output_bytes", 0))
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            self.counters["failed"] += 1
+            logger.exception("Errore nel job %s: %s", job.id, e)
+            FAILURES.labels("job").inc()
+            self._remove(tmp_path)
+        finally:
+            job.finished_at = time.time()
+            self._save(job)
+            self._remove(job.input_path)
+            admission.recycle_if_needed()
+
+    def _state_path(self, job_id: str) -> str:
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def _save(self, job: Job):
+        """Scrive lo stato del job in JOBS_DIR (scrittura atomica)."""
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, 'w') as f:
+                json.dump(job.state(), f)
+            os.replace(tmp_path, self._state_path(job.id))
+        except OSError as e:
+            logger.warning("Errore nel salvataggio dello stato del job %s: %s", job.id, e)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """Job di questo processo oppure, se manca, letto dallo stato salvato da un altro worker."""
+        self.expire()
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is not None:
+            return job
+        # Gli id sono uuid4 esadecimali: niente percorsi arbitrari
+        if len(job_id) != 32 or any(char not in "0123456789abcdef" for char in job_id):
+            return None
+        try:
+            with open(self._state_path(job_id)) as f:
+                job = Job.from_state(json.load(f), self.directory)
+                updated_at = os.fstat(f.fileno()).st_mtime
+        except (OSError, ValueError, KeyError):
+            return None
+        if not job.finished_at and time.time() - updated_at > JOB_STALE_AFTER:
+            job.status = "failed"
+            job.error = "Job interrotto: il worker che lo eseguiva e' stato terminato"
+            job.finished_at = updated_at
+        if job.finished_at and time.time() - job.finished_at > self.ttl:
+            return None
+        return job
+
+    def expire(self):
+        """Elimina i job conclusi da oltre ttl secondi e i relativi PDF."""
+        now = time.time()
+        with self.lock:
+            expired = [job for job in self.jobs.values()
+                       if job.finished_at and now - job.finished_at > self.ttl]
+            for job in expired:
+                del self.jobs[job.id]
+        for job in expired:
+            self._remove(job.result_path)
+            self._remove(self._state_path(job.id))
+            self.counters["expired"] += 1
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            by_status: Dict[str, int] = {}
+            for job in self.jobs.values():
+                by_status[job.status] = by_status.get(job.status, 0) + 1
+        return {"workers": self.executor._max_workers, **self.counters, **by_status}
+
+    def shutdown(self):
+        """
+        Attende i job in corso; quelli non ancora avviati vengono annullati e segnati
+        come falliti, cosi' gli altri worker non li riportano in coda per sempre.
+        """
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        with self.lock:
+            cancelled = [job for job in self.jobs.values() if job.status == "queued"]
+        for job in cancelled:
+            job.status = "failed"
+            job.error = "Job annullato per l'arresto del worker, da inviare di nuovo"
+            job.finished_at = time.time()
+            self.counters["failed"] += 1
+            self._save(job)
+            self._remove(job.input_path)
+        if cancelled:
+            logger.warning("Arresto del worker: %d job in coda annullati", len(cancelled))
+
+job_manager = JobManager(JOBS_DIR, JOB_WORKERS, JOB_MAX_QUEUED, JOB_RESULT_TTL)
+
+# Dimensione oltre la quale ZIP e dati base64 ricevuti vengono spostati su disco
+UPLOAD_SPOOL_MEMORY = int(os.getenv("UPLOAD_SPOOL_MEMORY", str(8 * 1024 * 1024)))
+# Caratteri base64 decodificati per volta (multiplo di 4)
+BASE64_CHUNK_CHARS = 4 * 1024 * 1024
+
+# Caratteri fuori dall'alfabeto base64, scartati come fa base64.b64decode
+BASE64_INVALID_CHARS = re.compile(r"[^A-Za-z0-9+/=]")
+
+def decode_base64_to_file(data: str, target: BinaryIO):
+    """
+    Decodifica il base64 a blocchi direttamente nel file target, senza tenere in
+    memoria una seconda copia decodificata. Come base64.b64decode ignora i caratteri
+    fuori dall'alfabeto (spazi, a capo, ...), prima di dividere in gruppi di 4.
+    """
+    carry = ""
+    for start in range(0, len(data), BASE64_CHUNK_CHARS):
+        piece = carry + BASE64_INVALID_CHARS.sub("", data[start:start + BASE64_CHUNK_CHARS])
+        usable = len(piece) - len(piece) % 4
+        target.write(base64.b64decode(piece[:usable]))
+        carry = piece[usable:]
+    if carry:
+        target.write(base64.b64decode(carry + "=" * (-len(carry) % 4)))
+
+class ZipInput:
+    """
+    ZIP ricevuto da una richiesta: file dell'upload multipart oppure file
+    temporaneo (in memoria fino a UPLOAD_SPOOL_MEMORY, poi su disco).
+    """
+    def __init__(self):
+        self.file: Optional[BinaryIO] = None
+        self.size = 0
+        self.fields: Dict[str, str] = {}
+        self._form = None
+        self._spool = None
+
+    def new_spool(self) -> BinaryIO:
+        self._spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MEMORY)
+        return self._spool
+
+    async def close(self):
+        if self._form is not None:
+            await self._form.close()
+        if self._spool is not None:
+            self._spool.close()
+
+async def read_zip_input(request: Request) -> ZipInput:
+    """
+    Legge lo ZIP dalla richiesta senza caricarlo tutto in memoria: upload multipart
+    (campo 'file'), campo form 'zip_data' in base64 oppure raw body.
+    """
+    zip_input = ZipInput()
+    content_type = request.headers.get("content-type", "")
+    
+    if content_type.startswith(("multipart/form-data", "application/x-www-form-urlencoded")):
+        form = await request.form()
+        zip_input._form = form
+        zip_input.fields = {key: value for key, value in form.items() if isinstance(value, str)}
+        upload = form.get("file")
+        zip_data = form.get("zip_data")
+        
+        # Gestione FILE ZIP UPLOAD (gia' su file temporaneo grazie al parser multipart)
+        if isinstance(upload, StarletteUploadFile):
+            logger.info("ZIP ricevuto come file upload: %s", upload.filename)
+            zip_input.file = upload.file
+        
+        # Gestione ZIP DATA in base64
+        elif zip_data:
+            logger.info("ZIP ricevuto come campo form base64")
+            spool = zip_input.new_spool()
+            try:
+                await run_in_threadpool(decode_base64_to_file, zip_data, spool)
+                zip_input.file = spool
+            except Exception as e:
+                logger.error("Errore nella decodifica base64: %s", e)
+    
+    # Gestione raw body, copiato a blocchi su file temporaneo
+    else:
+        spool = zip_input.new_spool()
+        async for chunk in request.stream():
+            spool.write(chunk)
+        if spool.tell():
+            spool.seek(0)
+            if spool.read(2) == b'PK': # Magic number per ZIP
+                logger.info("ZIP ricevuto come raw body")
+                zip_input.file = spool
+            else:
+                logger.warning("Body non è un file ZIP, ignorato")
+    
+    if zip_input.file is not None:
+        zip_input.size = zip_input.file.seek(0, os.SEEK_END)
+        zip_input.file.seek(0)
+        if not zip_input.size:
+            zip_input.file = None
+    return zip_input
+
+def parse_int(value: Optional[str]) -> Optional[int]:
+    """Converte un campo form in intero; None se assente o non valido."""
+    try:
+        return int(value) if value not in (None, "") else None
+    except ValueError:
+        logger.warning("Valore intero non valido ignorato: %r", value)
+        return None
+
 @app.post("/genera_pdf")
 async def genera_pdf(
     request: Request,
-    file: Optional[UploadFile] = File(None),
-    zip_data: Optional[str] = Form(None),
     link: Optional[str] = Header(None)
 ):
     """
     Endpoint POST per generare PDF.
     1. Riceve un file ZIP di immagini (da file, form data base64, o raw body).
+       Il form (multipart o urlencoded) viene letto a mano: campi 'file', 'zip_data'
+       e 'dpi'. Lo ZIP resta su file temporaneo e le immagini vengono lette una alla volta.
     2. Crea un PDF con una copertina e una pagina per ogni immagine.
     3. Se l'header 'link' è presente, aggiunge una pagina di screenshot per ogni URL.
+    La risoluzione delle immagini si imposta con l'header 'x-target-dpi' o il campo
+    form 'dpi' (es. 150/200/300, 0 = nessun ricampionamento).
+    Il profilo di uscita (header 'x-profilo' o campo form 'profilo': standard, print,
+    screen, email) sceglie risoluzione e compressione; l'header X-Images-Savings
+    riporta la riduzione ottenuta sulle immagini.
+    L'header 'x-screenshot-cache' (use/refresh/bypass) controlla la cache degli screenshot.
+    Il titolo della copertina si imposta con il campo form 'titolo' o l'header 'x-titolo'
+    (URL-encoded per i caratteri non ASCII).
+    Le richieste identiche (stesso ZIP, link e opzioni, nello stesso giorno) vengono
+    servite dalla cache dei PDF; l'ETag restituito si puo' usare con If-None-Match.
+    Con troppi ZIP grandi gia' in lavorazione (o durante il riavvio del worker)
+    risponde 503 con Retry-After.
     """
     
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print("=" * 60)
-    print(f"NUOVA RICHIESTA GENERA_PDF - {timestamp}")
-    print("=" * 60)
-    
-    print("\n--- HEADERS ---")
-    for header_name, header_value in request.headers.items():
-        print(f"{header_name}: {header_value}")
-    
-    # Gestione FILE ZIP UPLOAD
-    zip_binary_data = None
-    if file:
-        print("\n--- FILE UPLOAD ---")
-        print(f"Nome file: {file.filename}")
-        zip_binary_data = await file.read()
-    
-    # Gestione ZIP DATA in base64
-    elif zip_data:
-        print("\n--- ZIP DATA BASE64 ---")
-        try:
-            zip_binary_data = base64.b64decode(zip_data)
-        except Exception as e:
-            print(f"Errore nella decodifica base64: {e}")
+    request.state.started = time.perf_counter()
+    logger.info("Nuova richiesta genera_pdf - %s", timestamp)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Header: %s", {name: ("***" if name in REDACTED_HEADERS else value)
+                                    for name, value in request.headers.items()})
     
-    # Gestione raw body
-    else:
-        body = await request.body()
-        if body:
-            print("\n--- RAW BODY ---")
-            if body.startswith(b'PK'): # Magic number per ZIP
-                print("Body sembra essere un file ZIP!")
-                zip_binary_data = body
-            else:
-                print("Body non è un file ZIP, ignorato.")
+    # Lo ZIP viene chiuso da render_pdf_response, dopo l'invio della risposta
+    zip_input = await read_zip_input(request)
+    return await render_pdf_response(request, zip_input, link, timestamp)
 
+def parse_render_options(request: Request, fields: Dict[str, str]) -> RenderOptions:
+    """
+    Opzioni di rendering dagli header (x-profilo, x-target-dpi, x-screenshot-cache, x-titolo)
+    o dai campi form. Il profilo fissa la risoluzione, salvo DPI indicati esplicitamente.
+    """
+    options = RenderOptions()
+    profile = (request.headers.get("x-profilo") or fields.get("profilo") or "").lower()
+    if profile in OUTPUT_PROFILES:
+        options.profile = profile
+        options.target_dpi = OUTPUT_PROFILES[profile].target_dpi
+    elif profile:
+        logger.warning("Profilo di uscita sconosciuto ignorato: %r", profile)
+    target_dpi = parse_int(request.headers.get("x-target-dpi"))
+    if target_dpi is None:
+        target_dpi = parse_int(fields.get("dpi"))
+    if target_dpi is not None:
+        options.target_dpi = max(0, target_dpi)
+    cache_mode = request.headers.get("x-screenshot-cache", "").lower()
+    if cache_mode in SCREENSHOT_CACHE_MODES:
+        options.screenshot_cache = cache_mode
+    cover_title = clean_cover_title(fields.get("titolo") or request.headers.get("x-titolo"))
+    if cover_title:
+        options.cover_title = cover_title
+    return options
 
-    print("=" * 60)
-    print("INIZIO ELABORAZIONE")
-    print("=" * 60)
-    
-    if not zip_binary_data:
+def size_savings(input_bytes: int, output_bytes: int) -> str:
+    """Riduzione percentuale da input_bytes a output_bytes (es. "62.5%")."""
+    if not input_bytes:
+        return "0.0%"
+    return f"{(1 - output_bytes / input_bytes) * 100:.1f}%"
+
+# Dimensione oltre la quale il PDF generato viene spostato su disco
+OUTPUT_SPOOL_MEMORY = int(os.getenv("OUTPUT_SPOOL_MEMORY", str(16 * 1024 * 1024)))
+STREAM_CHUNK_SIZE = 256 * 1024
+
+async def iter_file_chunks(f: BinaryIO):
+    """Legge il file dall'inizio a blocchi di STREAM_CHUNK_SIZE, fuori dall'event loop."""
+    await run_in_threadpool(f.seek, 0)
+    while True:
+        chunk = await run_in_threadpool(f.read, STREAM_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+def parse_links(link: Optional[str]) -> List[str]:
+    """Pulisce e splitta i link dell'header, gestendo spazi e virgole multiple."""
+    return [url.strip() for url in link.split(',') if url.strip()] if link else []
+
+async def render_pdf_response(request: Request, zip_input: ZipInput, link: Optional[str], timestamp: str) -> Response:
+    if zip_input.file is None:
+        await zip_input.close()
         return Response(
             content=json.dumps({
                 "status": "error",
@@ -485,36 +2286,269 @@ async def genera_pdf(
             media_type="application/json"
         )
         
-    # 1. CREAZIONE DEL PDF DALLE IMMAGINI
-    print("\n" + "=" * 20 + " FASE 1: CREAZIONE PDF DA IMMAGINI " + "=" * 20)
-    pdf_bytes = create_pdf_from_images(zip_binary_data)
-    
-    # 2. AGGIUNTA SCREENSHOT SE IL LINK È PRESENTE
-    if link:
-        print("\n" + "=" * 20 + " FASE 2: AGGIUNTA SCREENSHOT " + "="*20)
-        # Pulisci e splitta i link, gestendo spazi e virgole multiple
-        links = [url.strip() for url in link.split(',') if url.strip()]
-        print(f"Trovati {len(links)} link nell'header: {links}")
-        
-        for i, single_link in enumerate(links):
-            print(f"\n--- Elaborazione link {i+1}/{len(links)}: {single_link} ---")
-            pdf_bytes = add_screenshot_to_pdf(pdf_bytes, single_link)
-        
-        print("\n" + "="*20 + " FINE AGGIUNTA SCREENSHOT " + "="*20)
+    options = parse_render_options(request, zip_input.fields)
+    links = parse_links(link)
+    headers = {
+        "Content-Disposition": f"attachment; filename=report_{timestamp.replace(' ', '_').replace(':', '-')}.pdf",
+        "X-Output-Profile": options.profile,
+    }
+    
+    # Richiesta gia' vista: 304 se il client ha lo stesso PDF, altrimenti il PDF dalla cache.
+    # Con x-screenshot-cache refresh/bypass si vogliono screenshot nuovi: niente cache.
+    cache_key = None
+    if output_cache.enabled and options.screenshot_cache == "use":
+        cache_key = await run_in_threadpool(OutputCache.key, zip_input.file, links, options)
+        etag = f'"{cache_key}"'
+        cached = await run_in_threadpool(output_cache.get, cache_key)
+        if cached is not None:
+            pdf_file, meta = cached
+            await zip_input.close()
+            # 304 solo se il PDF e' ancora in cache e valido: altrimenti va rigenerato
+            if etag_matches(request.headers.get("if-none-match"), etag):
+                output_cache.count("not_modified")
+                pdf_file.close()
+                return Response(status_code=304, headers={"ETag": etag})
+            logger.info("PDF servito dalla cache: %s", cache_key)
+            headers.update({
+                "ETag": etag,
+                "X-Cache": "HIT",
+                "Content-Length": str(meta["output_bytes"]),
+                "X-Input-Bytes": str(meta["input_bytes"]),
+                "X-Output-Bytes": str(meta["output_bytes"]),
+                "X-Images-Input-Bytes": str(meta["images_input_bytes"]),
+                "X-Images-Output-Bytes": str(meta["images_output_bytes"]),
+                "X-Images-Savings": size_savings(meta["images_input_bytes"], meta["images_output_bytes"]),
+            })
+            return StreamingResponse(iter_file_chunks(pdf_file), media_type="application/pdf", headers=headers,
+                                     background=BackgroundTask(pdf_file.close))
+    
+    # I rendering grandi sono limitati per worker; durante lo spegnimento non se ne avviano
+    rejection = admission.acquire(zip_input.size)
+    if rejection:
+        await zip_input.close()
+        return service_unavailable(rejection, timestamp)
+    
+    # Il PDF viene scritto su file temporaneo (su disco oltre OUTPUT_SPOOL_MEMORY)
+    # e la risposta lo invia a blocchi, senza copie in memoria
+    output = tempfile.SpooledTemporaryFile(max_size=OUTPUT_SPOOL_MEMORY)
+    render_stats: Dict[str, Any] = {}
+    
+    # Il rendering (CPU e chiamate HTTP bloccanti) gira fuori dall'event loop
+    render_task = asyncio.ensure_future(run_render(render_report, zip_input.file, links, options, output, render_stats))
+    started = getattr(request.state, "started", time.perf_counter())
+    render_task.add_done_callback(
+        lambda task: REQUEST_SECONDS.labels("genera_pdf").observe(time.perf_counter() - started))
+    
+    def cacheable() -> bool:
+        # Solo PDF completi: con uno screenshot mancante la richiesta va rifatta
+        return (cache_key is not None and render_task.done() and not render_task.cancelled()
+                and render_task.exception() is None and "error" not in render_stats and render_stats.get("screenshot_pages") == len(links))
+    
+    async def cleanup():
+        # Lo ZIP e il PDF temporaneo si chiudono solo a rendering concluso (anche se
+        # la richiesta e' stata annullata: run_render termina dopo il thread),
+        # dopo averne salvato una copia nella cache
+        try:
+            cancelled = await wait_until_done(render_task)
+            if cacheable() and not cancelled:
+                await run_in_threadpool(output_cache.put, cache_key, output, render_stats)
+            elif cache_key is not None:
+                output_cache.count("skipped")
+        finally:
+            output.close()
+            admission.release(zip_input.size)
+            await zip_input.close()
+    
+    try:
+        await asyncio.shield(render_task)
+    except BaseException:
+        await cleanup()
+        raise
+    
+    # 3. Restituisci il PDF finale (originale o modificato)
+    logger.debug("Invio risposta PDF: %d bytes", render_stats["output_bytes"])
+    if cacheable():
+        headers.update({"ETag": f'"{cache_key}"', "X-Cache": "MISS"})
+    headers.update({
+        "Content-Length": str(render_stats["output_bytes"]),
+        "X-Input-Bytes": str(render_stats["input_bytes"]),
+        "X-Output-Bytes": str(render_stats["output_bytes"]),
+        "X-Images-Input-Bytes": str(render_stats["images_input_bytes"]),
+        "X-Images-Output-Bytes": str(render_stats["images_output_bytes"]),
+        "X-Images-Savings": size_savings(render_stats["images_input_bytes"], render_stats["images_output_bytes"]),
+    })
+    return StreamingResponse(iter_file_chunks(output), media_type="application/pdf", headers=headers,
+                             background=BackgroundTask(cleanup))
 
+def parse_batch_manifest(request: Request, fields: Dict[str, str]) -> BatchManifest:
+    """
+    Manifest del batch dal campo form 'manifest' o dall'header 'x-manifest' (JSON):
+    {"reports": [{"name": ..., "images": [...], "links": [...]}]} oppure solo la lista.
+    Solleva ValueError se manca o non e' valido.
+    """
+    raw = fields.get("manifest") or request.headers.get("x-manifest")
+    if not raw:
+        raise ValueError("Manifest mancante (campo form 'manifest' o header 'x-manifest')")
+    data = json.loads(raw)
+    if isinstance(data, list):
+        data = {"reports": data}
+    manifest = BatchManifest.model_validate(data)
+    if not manifest.reports:
+        raise ValueError("Il manifest non contiene report")
+    if len(manifest.reports) > BATCH_MAX_REPORTS:
+        raise ValueError(f"Troppi report nel manifest (massimo {BATCH_MAX_REPORTS})")
+    return manifest
+
+@app.post("/genera_pdf_batch")
+async def genera_pdf_batch(request: Request):
+    """
+    Genera piu' report da un solo ZIP e restituisce uno ZIP con un PDF per report.
+    Lo ZIP si invia come per /genera_pdf; il manifest (campo 'manifest' o header
+    'x-manifest') indica per ogni report il nome, le immagini e i link.
+    """
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    started = time.perf_counter()
+    logger.info("Nuova richiesta batch - %s", timestamp)
+    
+    zip_input = await read_zip_input(request)
+    error = None
+    if zip_input.file is None:
+        error = "Nessun file ZIP valido ricevuto (controllare file upload, form 'zip_data' o raw body)"
     else:
-        print("\nNessun header 'link' trovato. Salto l'aggiunta di screenshot.")
+        try:
+            manifest = parse_batch_manifest(request, zip_input.fields)
+        except ValueError as e:
+            error = f"Manifest non valido: {e}"
+    if error:
+        await zip_input.close()
+        return Response(
+            content=json.dumps({"status": "error", "message": error, "timestamp": timestamp}),
+            status_code=400,
+            media_type="application/json"
+        )
+    
+    rejection = admission.acquire(zip_input.size)
+    if rejection:
+        await zip_input.close()
+        return service_unavailable(rejection, timestamp)
+    
+    options = parse_render_options(request, zip_input.fields)
+    output = tempfile.SpooledTemporaryFile(max_size=OUTPUT_SPOOL_MEMORY)
+    batch_stats: Dict[str, Any] = {}
+    try:
+        await run_render(render_batch, zip_input.file, manifest, options, output, batch_stats)
+        REQUEST_SECONDS.labels("batch").observe(time.perf_counter() - started)
+    except BaseException:
+        output.close()
+        raise
+    finally:
+        await zip_input.close()
+        admission.release(zip_input.size)
+    
+    headers = {
+        "Content-Disposition": f"attachment; filename=reports_{timestamp.replace(' ', '_').replace(':', '-')}.zip",
+        "Content-Length": str(batch_stats["output_bytes"]),
+        "X-Reports": str(batch_stats["reports"]),
+        "X-Shared-Images": str(batch_stats["shared_images"]),
+        "X-Output-Profile": options.profile,
+    }
+    return StreamingResponse(iter_file_chunks(output), media_type="application/zip", headers=headers,
+                             background=BackgroundTask(output.close))
 
-    # 3. Restituisci il PDF finale (originale o modificato)
-    print("\n" + "="*20 + " INVIO RISPOSTA PDF " + "="*20)
-    return StreamingResponse(
-        io.BytesIO(pdf_bytes),
-        media_type="application/pdf",
-        headers={
-            "Content-Disposition": f"attachment; filename=report_{timestamp.replace(' ', '_').replace(':', '-')}.pdf"
-        }
+@app.post("/jobs")
+async def create_job(
+    request: Request,
+    link: Optional[str] = Header(None)
+):
+    """
+    Come /genera_pdf, ma risponde subito (202) con l'id del job; il PDF viene
+    generato in background. Stato e avanzamento su GET /jobs/{id}, download su
+    GET /jobs/{id}/result quando lo stato e' 'done'.
+    """
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    logger.info("Nuovo job - %s", timestamp)
+    if admission.draining:
+        return service_unavailable("Server in riavvio, riprovare piu' tardi", timestamp)
+    
+    zip_input = await read_zip_input(request)
+    try:
+        if zip_input.file is None:
+            return Response(
+                content=json.dumps({
+                    "status": "error",
+                    "message": "Nessun file ZIP valido ricevuto (controllare file upload, form 'zip_data' o raw body)",
+                    "timestamp": timestamp
+                }),
+                status_code=400,
+                media_type="application/json"
+            )
+        options = parse_render_options(request, zip_input.fields)
+        job = await run_in_threadpool(job_manager.submit, zip_input.file, parse_links(link), options, timestamp)
+    finally:
+        await zip_input.close()
+    
+    if job is None:
+        return service_unavailable("Troppi job in coda, riprovare piu' tardi", timestamp)
+    
+    logger.info("Job %s in coda", job.id)
+    return Response(
+        content=json.dumps({
+            **job.to_dict(),
+            "status_url": f"/jobs/{job.id}",
+            "result_url": f"/jobs/{job.id}/result",
+        }),
+        status_code=202,
+        media_type="application/json"
+    )
+
+def job_not_found(job_id: str) -> Response:
+    return Response(
+        content=json.dumps({"status": "error", "message": f"Job {job_id} non trovato o scaduto"}),
+        status_code=404,
+        media_type="application/json"
     )
 
+# Endpoint sincroni: FastAPI li esegue nel threadpool, cosi' le letture dello stato
+# su disco (e la pulizia dei job scaduti) non bloccano l'event loop
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    """Stato e avanzamento (pagine completate / totali) di un job."""
+    job = job_manager.get(job_id)
+    if job is None:
+        return job_not_found(job_id)
+    return job.to_dict()
+
+@app.get("/jobs/{job_id}/result")
+def get_job_result(job_id: str):
+    """PDF generato dal job; 409 se il job non e' ancora concluso o e' fallito."""
+    job = job_manager.get(job_id)
+    if job is None:
+        return job_not_found(job_id)
+    if job.status != "done" or not os.path.exists(job.result_path):
+        return Response(
+            content=json.dumps(job.to_dict()),
+            status_code=409,
+            media_type="application/json"
+        )
+    filename = f"report_{job.timestamp.replace(' ', '_').replace(':', '-')}.pdf"
+    return FileResponse(job.result_path, media_type="application/pdf", filename=filename)
+
+@app.on_event("startup")
+async def load_shared_assets():
+    """Carica il logo nella cache all'avvio, cosi' le richieste non lo scaricano."""
+    logo_cache.get()
+
+@app.on_event("shutdown")
+async def release_workers():
+    """Spegnimento ordinato: nessun nuovo rendering, si completano quelli avviati e i job in coda."""
+    admission.draining = True
+    logger.info("Arresto del worker: %d rendering in corso, %d in attesa, %d job attivi",
+                render_metrics["in_flight"], render_metrics["queued"], job_manager.active_count())
+    render_executor.shutdown(wait=True)
+    job_manager.shutdown()
+    screenshot_executor.shutdown(wait=False, cancel_futures=True)
+    shutdown_image_executor()
+
 @app.get("/")
 async def root():
     """Endpoint di test per verificare che l'API funzioni"""
@@ -525,11 +2559,34 @@ async def health_check():
     """Health check endpoint"""
     return {"status": "healthy"}
 
+@app.get("/metrics")
+async def metrics():
+    """Metriche Prometheus; con PROMETHEUS_MULTIPROC_DIR aggrega quelle di tutti i worker"""
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(content=generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/stats")
+async def render_stats_endpoint():
+    """Richieste di rendering in coda, in corso e completate da questo worker"""
+    return {"max_concurrent_renders": MAX_CONCURRENT_RENDERS, **render_metrics,
+            "screenshot_cache": screenshot_cache.stats(), "cover_cache": cover_cache.stats(),
+            "output_cache": output_cache.stats(), "admission": admission.stats(),
+            "jobs": job_manager.stats()}
+
 if __name__ == "__main__":
-    print("Avvio del server FastAPI...")
-    print("Installare le dipendenze con:")
-    print("pip install fastapi uvicorn pillow reportlab requests PyPDF2")
-    print("\nServer disponibile su http://0.0.0.0:8000")
+    if sys.argv[1:2] == ["--production"] or os.getenv("PDF_SERVER_MODE") == "production":
+        # Produzione: gunicorn con worker uvicorn, configurato da gunicorn.conf.py.
+        # Un nuovo interprete, cosi' le variabili impostate dalla configurazione
+        # (es. PROMETHEUS_MULTIPROC_DIR) valgono gia' all'import dei worker
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        logger.info("Avvio in produzione con gunicorn (configurazione: gunicorn.conf.py)")
+        os.execvp(sys.executable, [sys.executable, "-m", "gunicorn", "--chdir", base_dir,
+                                   "-c", os.path.join(base_dir, "gunicorn.conf.py"), "main:app"])
+    
+    logger.info("Avvio del server FastAPI su http://0.0.0.0:8000 (dipendenze: pip install -r requirements.txt)")
     
     uvicorn.run(
         "main:app",
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# main.py e' un modulo singolo nella radice del repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Nessun download del logo durante i test
+os.environ.setdefault("LOGO_URL", "")
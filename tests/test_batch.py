@@ -0,0 +1,97 @@
+import io
+import threading
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from PIL import Image
+from PyPDF2 import PdfReader
+
+import main
+
+
+def png_bytes(color, size=(160, 120)) -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", size, color).save(buf, "PNG")
+    return buf.getvalue()
+
+
+def zip_file(names) -> io.BytesIO:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        for i, name in enumerate(names):
+            z.writestr(name, png_bytes((i * 40, 80, 120)))
+    buf.seek(0)
+    return buf
+
+
+def test_batch_file_names():
+    manifest = main.BatchManifest.model_validate({"reports": [
+        {"name": "cliente/uno"},
+        {"name": "uno.pdf"},
+        {"name": "..\\altro\\uno.PDF"},
+        {"name": ""},
+        {"name": "   "},
+        {"name": "due"},
+    ]})
+    assert main.batch_file_names(manifest) == [
+        "uno.pdf", "uno_2.pdf", "uno_3.pdf", "report_4.pdf", "report_5.pdf", "due.pdf"]
+
+
+def test_collect_screenshots_timeout_keeps_shared_futures(monkeypatch):
+    monkeypatch.setattr(main, "SCREENSHOT_TIMEOUT", 0.05)
+    shared = [Future(), Future()]
+    assert list(main.collect_screenshots(["a", "b"], shared, cancel_on_timeout=False)) == [("a", None), ("b", None)]
+    assert not any(future.cancelled() for future in shared)
+    own = [Future(), Future()]
+    assert list(main.collect_screenshots(["a", "b"], own)) == [("a", None), ("b", None)]
+    assert all(future.cancelled() for future in own)
+
+
+def test_render_batch_fetches_each_link_once(monkeypatch):
+    monkeypatch.setattr(main, "IMAGE_WORKERS", 1)
+    events = []
+    lock = threading.Lock()
+
+    def fake_fetch(link, cache_mode="use"):
+        with lock:
+            events.append(("fetch", link))
+        return png_bytes((10, 200, 10), (400, 300))
+
+    prepare_images = main.prepare_images
+
+    def recording_prepare_images(*args, **kwargs):
+        events.append(("prepare_images", None))
+        return prepare_images(*args, **kwargs)
+
+    executor = ThreadPoolExecutor(max_workers=2)
+    submit = executor.submit
+
+    def recording_submit(*args, **kwargs):
+        events.append(("submit", None))
+        return submit(*args, **kwargs)
+
+    monkeypatch.setattr(executor, "submit", recording_submit)
+    monkeypatch.setattr(main, "screenshot_executor", executor)
+    monkeypatch.setattr(main, "fetch_screenshot", fake_fetch)
+    monkeypatch.setattr(main, "prepare_images", recording_prepare_images)
+
+    links = ["https://x1.it/", "https://x2.it/", "https://x3.it/"]
+    manifest = main.BatchManifest.model_validate({"reports": [
+        {"name": "uno", "images": ["comune.png", "uno.png"], "links": links},
+        {"name": "due", "images": ["comune.png"], "links": links[1:]},
+    ]})
+    output = io.BytesIO()
+    stats = {}
+    main.render_batch(zip_file(["comune.png", "uno.png"]), manifest, main.RenderOptions(), output, stats)
+    executor.shutdown()
+
+    assert sorted(link for kind, link in events if kind == "fetch") == links
+    # Gli screenshot partono prima della preparazione delle immagini condivise
+    kinds = [kind for kind, _ in events]
+    assert kinds.index("submit") < kinds.index("prepare_images")
+    assert stats["shared_images"] == 1 and stats["screenshot_links"] == 3
+    with zipfile.ZipFile(output) as z:
+        assert z.namelist() == ["uno.pdf", "due.pdf"]
+        # Copertina + immagini + una pagina per link
+        assert len(PdfReader(io.BytesIO(z.read("uno.pdf"))).pages) == 1 + 2 + 3
+        assert len(PdfReader(io.BytesIO(z.read("due.pdf"))).pages) == 1 + 1 + 2
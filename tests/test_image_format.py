@@ -0,0 +1,64 @@
+import io
+import zipfile
+
+import pytest
+from PIL import Image
+
+import main
+
+
+@pytest.mark.parametrize("header, expected", [
+    (b"\xff\xd8\xff\xe0\x00\x10JFIF", "JPEG"),
+    (b"\x89PNG\r\n\x1a\n\x00\x00", "PNG"),
+    (b"GIF89a\x01\x00", "GIF"),
+    (b"GIF87a\x01\x00", "GIF"),
+    (b"BM\x00\x00", "BMP"),
+    (b"II*\x00\x08\x00", "TIFF"),
+    (b"MM\x00*\x00\x08", "TIFF"),
+    (b"RIFF\x00\x00\x00\x00WEBPVP8 ", "WEBP"),
+    (b"RIFF\x00\x00\x00\x00WAVEfmt ", None),
+    (b"<html><body>", None),
+    (b"", None),
+])
+def test_sniff_image_format(header, expected):
+    assert main.sniff_image_format(header) == expected
+
+
+@pytest.mark.parametrize("name, expected", [
+    ("foto/", True),
+    ("__MACOSX/foto/img.jpg", True),
+    ("foto/._img.jpg", True),
+    ("._img.jpg", True),
+    ("foto/img.jpg", False),
+    ("img_.jpg", False),
+])
+def test_is_zip_metadata(name, expected):
+    assert main.is_zip_metadata(zipfile.ZipInfo(name)) is expected
+
+
+def image_bytes(image_format: str) -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", (64, 48), (200, 100, 50)).save(buf, image_format)
+    return buf.getvalue()
+
+
+def test_select_image_entries_sniffs_files_without_extension():
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        z.writestr("foto.jpg", image_bytes("JPEG"))
+        z.writestr("cartella/", b"")
+        z.writestr("cartella/senza_ext", image_bytes("PNG"))
+        z.writestr("__MACOSX/cartella/._senza_ext", b"\x00\x05\x16\x07")
+        z.writestr("note.txt", b"non e' un'immagine")
+    with zipfile.ZipFile(buf) as z:
+        names, formats = main.select_image_entries(z)
+    assert names == ["foto.jpg", "cartella/senza_ext"]
+    assert formats == {"cartella/senza_ext": "PNG"}
+
+
+def test_prepare_image_uses_sniffed_format():
+    # PNG senza estensione: resta senza perdita (Flate) grazie al formato riconosciuto
+    prepared = main.prepare_image("senza_ext", image_bytes("PNG"), 500, 700, image_format="PNG")
+    assert prepared.error is None and prepared.filters == ("FlateDecode",)
+    jpeg = main.prepare_image("senza_ext", image_bytes("JPEG"), 500, 700, image_format="JPEG")
+    assert jpeg.error is None and jpeg.passthrough
@@ -0,0 +1,145 @@
+import io
+import os
+import signal
+import zipfile
+
+import pytest
+from PIL import Image
+
+import main
+
+
+def image_bytes(size=(300, 200), color=(200, 40, 90), image_format="PNG", **save_args) -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", size, color).save(buf, image_format, **save_args)
+    return buf.getvalue()
+
+
+def make_zip(files) -> zipfile.ZipFile:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        for name, data in files.items():
+            z.writestr(name, data)
+    return zipfile.ZipFile(buf)
+
+
+@pytest.fixture
+def process_pool(monkeypatch):
+    main.shutdown_image_executor()
+    monkeypatch.setattr(main, "IMAGE_WORKERS", 2)
+    monkeypatch.setattr(main, "IMAGE_EXECUTOR", "process")
+    yield
+    main.shutdown_image_executor()
+
+
+def kill_pool_processes():
+    for pid in list(main.get_image_executor()._processes):
+        os.kill(pid, signal.SIGKILL)
+
+
+def test_prepare_images_replaces_broken_process_pool(process_pool):
+    files = {f"img{i}.png": image_bytes(color=(i * 20, 40, 90)) for i in range(6)}
+    with make_zip(files) as z:
+        assert all(p.error is None for p in main.prepare_images(z, list(files), 500, 700))
+        broken = main.get_image_executor()
+        kill_pool_processes()
+        # Pool rotto tra due documenti: il documento successivo usa un pool nuovo
+        assert all(p.error is None for p in main.prepare_images(z, list(files), 500, 700))
+        assert main.get_image_executor() is not broken
+
+
+def test_prepare_images_retries_pages_after_worker_death(process_pool):
+    files = {f"img{i}.png": image_bytes(color=(i * 20, 40, 90)) for i in range(8)}
+    with make_zip(files) as z:
+        prepared = main.prepare_images(z, list(files), 500, 700)
+        first = next(prepared)
+        kill_pool_processes()
+        rest = list(prepared)
+    assert [p.filename for p in [first] + rest] == list(files)
+    assert all(p.error is None and p.stream for p in [first] + rest)
+
+
+def jpeg_with_exif_orientation(orientation: int) -> bytes:
+    img = Image.new("RGB", (300, 200), (20, 120, 220))
+    exif = img.getexif()
+    exif[main.EXIF_ORIENTATION_TAG] = orientation
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", exif=exif)
+    return buf.getvalue()
+
+
+@pytest.mark.parametrize("save_args", [{}, {"progressive": True}])
+def test_prepare_image_embeds_rgb_jpeg_unchanged(save_args):
+    data = image_bytes(image_format="JPEG", **save_args)
+    prepared = main.prepare_image("foto.jpg", data, 500, 700)
+    assert prepared.error is None and prepared.passthrough
+    assert prepared.stream == data
+    assert prepared.filters == ("DCTDecode",) and prepared.color_space == "DeviceRGB"
+    assert (prepared.width, prepared.height) == (300, 200)
+
+
+def test_prepare_image_embeds_grayscale_jpeg_as_device_gray():
+    buf = io.BytesIO()
+    Image.new("L", (120, 80), 128).save(buf, "JPEG")
+    prepared = main.prepare_image("grigio.jpg", buf.getvalue(), 500, 700)
+    assert prepared.passthrough and prepared.color_space == "DeviceGray"
+
+
+def test_prepare_image_decodes_cmyk_jpeg():
+    buf = io.BytesIO()
+    Image.new("CMYK", (120, 80), (0, 50, 100, 0)).save(buf, "JPEG")
+    prepared = main.prepare_image("cmyk.jpg", buf.getvalue(), 500, 700)
+    assert prepared.error is None and not prepared.passthrough
+    assert prepared.color_space == "DeviceRGB"
+
+
+def test_prepare_image_decodes_rotated_jpeg():
+    prepared = main.prepare_image("ruotata.jpg", jpeg_with_exif_orientation(6), 500, 700)
+    assert prepared.error is None and not prepared.passthrough
+    # Orientamento applicato: larghezza e altezza scambiate
+    assert (prepared.width, prepared.height) == (200, 300)
+    assert prepared.scaled_height > prepared.scaled_width
+
+
+def test_prepare_image_encodes_png_losslessly():
+    prepared = main.prepare_image("img.png", image_bytes(), 500, 700)
+    assert not prepared.passthrough and prepared.filters == ("FlateDecode",)
+
+
+def test_create_pdf_embeds_jpeg_bytes_verbatim(monkeypatch):
+    monkeypatch.setattr(main, "IMAGE_WORKERS", 1)
+    data = image_bytes(size=(400, 300), image_format="JPEG", quality=85)
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        z.writestr("foto.jpg", data)
+    pdf = main.create_pdf_from_images(buf.getvalue(), main.RenderOptions(target_dpi=0))
+    assert data in pdf
+
+
+def test_target_pixel_size():
+    assert main.target_pixel_size(72, 144, 200) == (200, 400)
+    assert main.target_pixel_size(500, 0.1, 150) == (1042, 1)
+
+
+@pytest.mark.parametrize("image_format", ["JPEG", "PNG"])
+def test_prepare_image_downsamples_to_target_dpi(image_format):
+    data = image_bytes(size=(3000, 2000), image_format=image_format)
+    prepared = main.prepare_image("grande." + image_format.lower(), data, 500, 700, target_dpi=200)
+    assert prepared.error is None and prepared.downsampled and not prepared.passthrough
+    # 500 punti a 200 DPI
+    assert (prepared.width, prepared.height) == main.target_pixel_size(500, 500 * 2000 / 3000, 200)
+    assert (prepared.scaled_width, prepared.scaled_height) == pytest.approx((500, 500 * 2000 / 3000))
+
+
+def test_prepare_image_keeps_images_within_tolerance():
+    # Appena sopra la risoluzione richiesta (entro DOWNSAMPLE_TOLERANCE): nessun ricampionamento
+    width = int(main.target_pixel_size(500, 1, 200)[0] * 1.05)
+    data = image_bytes(size=(width, width // 2), image_format="JPEG")
+    prepared = main.prepare_image("foto.jpg", data, 500, 700, target_dpi=200)
+    assert prepared.passthrough and not prepared.downsampled and prepared.width == width
+
+
+def test_prepare_image_without_target_dpi_keeps_resolution():
+    data = image_bytes(size=(3000, 2000), image_format="PNG")
+    prepared = main.prepare_image("grande.png", data, 500, 700, target_dpi=0)
+    assert not prepared.downsampled and (prepared.width, prepared.height) == (3000, 2000)
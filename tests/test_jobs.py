@@ -0,0 +1,140 @@
+import io
+import json
+import os
+import threading
+import time
+import zipfile
+
+import pytest
+from PIL import Image
+
+import main
+
+
+def zip_file(count=2) -> io.BytesIO:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        for i in range(count):
+            image = io.BytesIO()
+            Image.new("RGB", (120, 80), (i * 60, 90, 30)).save(image, "PNG")
+            z.writestr(f"img{i}.png", image.getvalue())
+    buf.seek(0)
+    return buf
+
+
+def wait_finished(job, timeout=30):
+    deadline = time.monotonic() + timeout
+    while job.status in ("queued", "running"):
+        assert time.monotonic() < deadline, "job non concluso"
+        time.sleep(0.01)
+    return job
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "IMAGE_WORKERS", 1)
+    manager = main.JobManager(str(tmp_path / "jobs"), workers=1, max_queued=2, ttl=60)
+    yield manager
+    manager.executor.shutdown(wait=True, cancel_futures=True)
+
+
+def submit(manager, zip_data=None):
+    return manager.submit(zip_data or zip_file(), [], main.RenderOptions(), "2026-01-01 10:00:00")
+
+
+def test_job_runs_to_done_and_cleans_up_input(manager):
+    job = wait_finished(submit(manager))
+    assert job.status == "done" and job.error is None
+    assert job.pages_done == job.pages_total == 3
+    with open(job.result_path, "rb") as f:
+        assert f.read(5) == b"%PDF-"
+    assert not os.path.exists(job.input_path)
+    info = job.to_dict()
+    assert info["status"] == "done" and info["output_bytes"] == os.path.getsize(job.result_path)
+    assert manager.stats()["completed"] == 1
+
+
+def test_failed_render_marks_job_failed(manager, monkeypatch):
+    def broken_render(*args, **kwargs):
+        raise RuntimeError("rendering fallito")
+    monkeypatch.setattr(main, "render_report", broken_render)
+    job = wait_finished(submit(manager))
+    assert job.status == "failed" and job.error == "rendering fallito"
+    assert not os.path.exists(job.result_path) and not os.path.exists(job.result_path + ".tmp")
+    assert manager.stats()["failed"] == 1
+
+
+def test_full_queue_rejects_and_shutdown_fails_queued_jobs(manager, monkeypatch):
+    release = threading.Event()
+    render_report = main.render_report
+
+    def blocking_render(*args, **kwargs):
+        release.wait(10)
+        return render_report(*args, **kwargs)
+    monkeypatch.setattr(main, "render_report", blocking_render)
+
+    running = submit(manager)
+    queued = submit(manager)
+    assert submit(manager) is None
+    assert manager.stats()["rejected"] == 1
+    release.set()
+    manager.shutdown()
+    assert wait_finished(running).status == "done"
+    # Il secondo job e' partito o e' stato annullato e segnato come fallito
+    assert queued.status in ("done", "failed")
+    with open(manager._state_path(queued.id)) as f:
+        assert json.load(f)["status"] == queued.status
+
+
+def test_job_state_is_shared_through_the_directory(manager):
+    job = wait_finished(submit(manager))
+    other = main.JobManager(manager.directory, workers=1, max_queued=2, ttl=60)
+    try:
+        shared = other.get(job.id)
+        assert shared.status == "done" and shared.result_path == job.result_path
+        assert other.get("0" * 32) is None and other.get("../segreto") is None
+    finally:
+        other.executor.shutdown()
+
+
+def test_stale_unfinished_state_is_reported_failed(manager):
+    # Stato lasciato da un worker terminato mentre eseguiva il job
+    job = main.Job("a" * 32, [], main.RenderOptions(), "2026-01-01 10:00:00")
+    job.status = "running"
+    manager._save(job)
+    assert manager.get(job.id).status == "running"
+    path = manager._state_path(job.id)
+    old = time.time() - main.JOB_STALE_AFTER - 5
+    os.utime(path, (old, old))
+    other = main.JobManager(manager.directory, workers=1, max_queued=2, ttl=main.JOB_STALE_AFTER + 60)
+    try:
+        reported = other.get(job.id)
+    finally:
+        other.executor.shutdown()
+    assert reported.status == "failed" and "interrotto" in reported.error
+    assert reported.finished_at == pytest.approx(old)
+
+
+def test_finished_jobs_expire_after_ttl(manager):
+    job = wait_finished(submit(manager))
+    job.finished_at = time.time() - manager.ttl - 1
+    assert manager.get(job.id) is None
+    assert not os.path.exists(job.result_path)
+    assert not os.path.exists(manager._state_path(job.id))
+    assert manager.stats()["expired"] == 1
+
+
+def test_job_endpoints(manager, monkeypatch):
+    pytest.importorskip("httpx")
+    from fastapi.testclient import TestClient
+    monkeypatch.setattr(main, "job_manager", manager)
+    client = TestClient(main.app)
+    created = client.post("/jobs", files={"file": ("immagini.zip", zip_file().getvalue(), "application/zip")})
+    assert created.status_code == 202
+    job_id = created.json()["job_id"]
+    wait_finished(manager.jobs[job_id])
+    status = client.get(f"/jobs/{job_id}")
+    assert status.status_code == 200 and status.json()["status"] == "done"
+    result = client.get(f"/jobs/{job_id}/result")
+    assert result.status_code == 200 and result.content.startswith(b"%PDF-")
+    assert client.get(f"/jobs/{'f' * 32}").status_code == 404
@@ -0,0 +1,109 @@
+import io
+import os
+import time
+import zipfile
+
+import pytest
+from PIL import Image
+
+import main
+
+
+def zip_bytes(count=2) -> bytes:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        for i in range(count):
+            image = io.BytesIO()
+            Image.new("RGB", (120, 80), (i * 60, 90, 30)).save(image, "PNG")
+            z.writestr(f"img{i}.png", image.getvalue())
+    return buf.getvalue()
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = main.OutputCache(str(tmp_path / "pdf_cache"), max_bytes=10 * 1024 * 1024, ttl=3600)
+    monkeypatch.setattr(main, "output_cache", cache)
+    monkeypatch.setattr(main, "IMAGE_WORKERS", 1)
+    return cache
+
+
+def store(cache, key, content=b"%PDF-1.4 finto"):
+    cache.put(key, io.BytesIO(content), {"input_bytes": 10, "output_bytes": len(content),
+                                         "images_input_bytes": 5, "images_output_bytes": 4})
+
+
+def test_output_cache_miss_then_hit(cache):
+    assert cache.get("a" * 64) is None
+    store(cache, "a" * 64)
+    pdf_file, meta = cache.get("a" * 64)
+    with pdf_file:
+        assert pdf_file.read() == b"%PDF-1.4 finto"
+    assert meta["output_bytes"] == len(b"%PDF-1.4 finto")
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_output_cache_expired_entry_is_a_miss(cache):
+    store(cache, "b" * 64)
+    pdf_path, _ = cache._paths("b" * 64)
+    old = time.time() - cache.ttl - 10
+    os.utime(pdf_path, (old, old))
+    assert cache.get("b" * 64) is None
+
+
+def test_output_cache_key_depends_on_zip_links_and_options():
+    data = zip_bytes()
+    key = main.OutputCache.key(io.BytesIO(data), [], main.RenderOptions())
+    assert key == main.OutputCache.key(io.BytesIO(data), [], main.RenderOptions())
+    assert key != main.OutputCache.key(io.BytesIO(data), ["https://example.it/"], main.RenderOptions())
+    assert key != main.OutputCache.key(io.BytesIO(data), [], main.RenderOptions(profile="email"))
+    assert key != main.OutputCache.key(io.BytesIO(zip_bytes(3)), [], main.RenderOptions())
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, False),
+    ("", False),
+    ('"abc"', True),
+    ('W/"abc"', True),
+    ('"xyz", "abc"', True),
+    ('"xyz"', False),
+    # '*' non e' supportato: non basta per avere un 304
+    ("*", False),
+    ("abc", False),
+])
+def test_etag_matches(header, expected):
+    assert main.etag_matches(header, '"abc"') is expected
+
+
+@pytest.fixture
+def client(cache):
+    pytest.importorskip("httpx")
+    from fastapi.testclient import TestClient
+    return TestClient(main.app)
+
+
+def post_zip(client, data, **headers):
+    return client.post("/genera_pdf", files={"file": ("immagini.zip", data, "application/zip")}, headers=headers)
+
+
+def test_genera_pdf_is_served_from_cache_with_etag(client, cache):
+    data = zip_bytes()
+    first = post_zip(client, data)
+    assert first.status_code == 200 and first.content.startswith(b"%PDF")
+    assert first.headers.get("x-cache") != "HIT"
+    etag = first.headers["etag"]
+    second = post_zip(client, data)
+    assert second.headers["x-cache"] == "HIT" and second.headers["etag"] == etag
+    assert second.content == first.content
+    assert post_zip(client, data, **{"If-None-Match": etag}).status_code == 304
+
+
+def test_genera_pdf_if_none_match_without_cached_pdf_renders(client, cache):
+    data = zip_bytes()
+    # Cache vuota: nessun 304, nemmeno con '*' o con l'ETag giusto
+    star = post_zip(client, data, **{"If-None-Match": "*"})
+    assert star.status_code == 200 and star.content.startswith(b"%PDF")
+    etag = star.headers["etag"]
+    for name in os.listdir(cache.directory):
+        os.remove(os.path.join(cache.directory, name))
+    again = post_zip(client, data, **{"If-None-Match": etag})
+    assert again.status_code == 200 and again.content.startswith(b"%PDF")
@@ -0,0 +1,102 @@
+import io
+import random
+import zipfile
+
+import pytest
+from PIL import Image
+
+import main
+
+
+def noisy_image(size=(1200, 900), gray=False) -> Image.Image:
+    rng = random.Random(7)
+    pixels = bytes(rng.randrange(256) for _ in range(size[0] * size[1]))
+    img = Image.frombytes("L", size, pixels)
+    return img if gray else Image.merge("RGB", (img, img.rotate(90, expand=False), img.transpose(Image.FLIP_LEFT_RIGHT)))
+
+
+def encoded(img: Image.Image, image_format: str) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, image_format, **({"quality": 95} if image_format == "JPEG" else {}))
+    return buf.getvalue()
+
+
+def zip_bytes(files) -> bytes:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        for name, data in files.items():
+            z.writestr(name, data)
+    return buf.getvalue()
+
+
+@pytest.fixture(autouse=True)
+def inline_images(monkeypatch):
+    monkeypatch.setattr(main, "IMAGE_WORKERS", 1)
+
+
+def test_prepare_images_dedupes_identical_content():
+    same = encoded(noisy_image((300, 200)), "PNG")
+    other = encoded(noisy_image((200, 300)), "PNG")
+    with zipfile.ZipFile(io.BytesIO(zip_bytes({"a.png": same, "b.png": other, "copia/a.png": same}))) as z:
+        prepared = list(main.prepare_images(z, ["a.png", "b.png", "copia/a.png"], 500, 700))
+        undeduped = list(main.prepare_images(z, ["a.png", "copia/a.png"], 500, 700, dedupe=False))
+    assert [p.filename for p in prepared] == ["a.png", "b.png", "copia/a.png"]
+    assert [p.duplicate for p in prepared] == [False, False, True]
+    assert prepared[2].name == prepared[0].name and prepared[2].stream == b""
+    assert not any(p.duplicate for p in undeduped)
+
+
+def test_prepare_images_dedupes_on_the_pool(monkeypatch):
+    main.shutdown_image_executor()
+    monkeypatch.setattr(main, "IMAGE_WORKERS", 2)
+    monkeypatch.setattr(main, "IMAGE_EXECUTOR", "thread")
+    same = encoded(noisy_image((300, 200)), "PNG")
+    names = [f"img{i}.png" for i in range(6)]
+    try:
+        with zipfile.ZipFile(io.BytesIO(zip_bytes({name: same for name in names}))) as z:
+            prepared = list(main.prepare_images(z, names, 500, 700))
+    finally:
+        main.shutdown_image_executor()
+    assert [p.filename for p in prepared] == names
+    assert [p.duplicate for p in prepared] == [False] + [True] * 5
+
+
+def test_create_pdf_embeds_duplicate_images_once():
+    same = encoded(noisy_image((600, 400)), "JPEG")
+    stats = {}
+    pdf = main.create_pdf_from_images(zip_bytes({"a.jpg": same, "b.jpg": same, "c.jpg": same}),
+                                      main.RenderOptions(target_dpi=0), stats)
+    assert stats["images_deduplicated"] == 2
+    assert pdf.count(same) == 1
+
+
+@pytest.mark.parametrize("name", ["standard", "print", "screen", "email"])
+def test_render_options_follow_profile(name):
+    options = main.RenderOptions(profile=name, target_dpi=main.OUTPUT_PROFILES[name].target_dpi)
+    assert options.output_profile() == main.OUTPUT_PROFILES[name]
+
+
+def test_grayscale_profile_stores_gray_images_on_one_channel():
+    data = encoded(noisy_image((300, 200), gray=True).convert("RGB"), "PNG")
+    standard = main.prepare_image("grigia.png", data, 500, 700, profile=main.OUTPUT_PROFILES["standard"])
+    screen = main.prepare_image("grigia.png", data, 500, 700, profile=main.OUTPUT_PROFILES["screen"])
+    assert standard.color_space == "DeviceRGB" and not standard.grayscale
+    assert screen.color_space == "DeviceGray" and screen.grayscale
+    assert len(screen.stream) < len(standard.stream)
+
+
+def test_email_profile_is_smaller_than_standard():
+    files = {"foto.jpg": encoded(noisy_image(), "JPEG"), "grafica.png": encoded(noisy_image((800, 600)), "PNG")}
+    sizes = {}
+    for name in ("standard", "email"):
+        stats = {}
+        options = main.RenderOptions(profile=name, target_dpi=main.OUTPUT_PROFILES[name].target_dpi)
+        sizes[name] = len(main.create_pdf_from_images(zip_bytes(files), options, stats))
+        assert stats["profile"] == name
+    assert sizes["email"] < sizes["standard"] / 2
+
+
+def test_size_savings():
+    assert main.size_savings(0, 0) == "0.0%"
+    assert main.size_savings(200, 50) == "75.0%"
+    assert main.size_savings(100, 120) == "-20.0%"
@@ -0,0 +1,45 @@
+import io
+import zipfile
+
+import pytest
+from PIL import Image
+
+import main
+
+
+def zip_bytes(count=3) -> bytes:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        for i in range(count):
+            image = io.BytesIO()
+            Image.new("RGB", (400, 300), (i * 60, 90, 30)).save(image, "PNG")
+            z.writestr(f"img{i}.png", image.getvalue())
+    return buf.getvalue()
+
+
+@pytest.fixture
+def client(monkeypatch):
+    pytest.importorskip("httpx")
+    from fastapi.testclient import TestClient
+    monkeypatch.setattr(main, "IMAGE_WORKERS", 1)
+    monkeypatch.setattr(main, "output_cache", main.OutputCache("", max_bytes=0, ttl=0))
+    return TestClient(main.app)
+
+
+def test_genera_pdf_sends_spooled_pdf_with_size_headers(client, monkeypatch):
+    # PDF piu' grande della soglia: passa dal file su disco, inviato a blocchi
+    monkeypatch.setattr(main, "OUTPUT_SPOOL_MEMORY", 1024)
+    monkeypatch.setattr(main, "STREAM_CHUNK_SIZE", 4096)
+    data = zip_bytes()
+    response = client.post("/genera_pdf", files={"file": ("immagini.zip", data, "application/zip")})
+    assert response.status_code == 200
+    assert response.content.startswith(b"%PDF-") and response.content.rstrip().endswith(b"%%EOF")
+    assert int(response.headers["content-length"]) == len(response.content) > 4096
+    assert int(response.headers["x-output-bytes"]) == len(response.content)
+    assert int(response.headers["x-input-bytes"]) == len(data)
+    assert "x-images-savings" in response.headers
+
+
+def test_genera_pdf_rejects_missing_zip(client):
+    response = client.post("/genera_pdf", content=b"")
+    assert response.status_code == 400 and response.json()["status"] == "error"
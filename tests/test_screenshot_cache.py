@@ -0,0 +1,101 @@
+import io
+import os
+
+import pytest
+from PIL import Image
+
+import main
+
+
+def png_bytes() -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", (40, 30), (10, 120, 200)).save(buf, "PNG")
+    return buf.getvalue()
+
+
+@pytest.mark.parametrize("link, expected", [
+    ("HTTPS://Example.IT:443/prodotto?id=1#foto", "https://example.it/prodotto?id=1"),
+    ("http://example.it:80", "http://example.it/"),
+    ("http://example.it:8080/a", "http://example.it:8080/a"),
+    ("https%3A%2F%2Fexample.it%2Fa%20b", "https://example.it/a b"),
+    ("  https://example.it/  ", "https://example.it/"),
+])
+def test_normalize_url(link, expected):
+    assert main.normalize_url(link) == expected
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = main.ScreenshotCache(str(tmp_path / "screenshots"), ttl=60, memory_items=2,
+                                 max_disk_bytes=10 * 1024 * 1024)
+    monkeypatch.setattr(main, "screenshot_cache", cache)
+    return cache
+
+
+class Clock:
+    def __init__(self, monkeypatch):
+        self.now = main.time.time()
+        monkeypatch.setattr(main.time, "time", lambda: self.now)
+
+
+def test_screenshot_cache_memory_and_disk_hits(cache):
+    cache.put("k", b"dati")
+    assert cache.get("k") == b"dati"
+    # Un altro processo (cache vuota in memoria) legge lo stesso file su disco
+    other = main.ScreenshotCache(cache.directory, cache.ttl, 2, cache.max_disk_bytes)
+    assert other.get("k") == b"dati"
+    assert cache.stats()["memory_hits"] == 1 and other.stats()["disk_hits"] == 1
+
+
+def test_screenshot_cache_expires_after_ttl(cache, monkeypatch):
+    clock = Clock(monkeypatch)
+    cache.put("k", b"dati")
+    path = cache._path("k")
+    os.utime(path, (clock.now, clock.now))
+    clock.now += cache.ttl - 1
+    assert cache.get("k") == b"dati"
+    clock.now += 2
+    assert cache.get("k") is None
+    # Il file scaduto viene eliminato
+    assert not os.path.exists(path)
+    assert cache.stats()["misses"] == 1
+
+
+def test_screenshot_cache_keys_ignore_url_spelling():
+    key = main.ScreenshotCache.key("https://example.it/a", 960, 1300, 6000, "stub")
+    assert key == main.ScreenshotCache.key("HTTPS://EXAMPLE.IT:443/a#x", 960, 1300, 6000, "stub")
+    assert key != main.ScreenshotCache.key("https://example.it/a", 960, 1300, 6000, "pikwy")
+
+
+class CountingProvider(main.ScreenshotProvider):
+    name = "test"
+
+    def __init__(self, content: bytes):
+        self.content = content
+        self.calls = 0
+
+    def capture(self, link, width, height, delay):
+        self.calls += 1
+        return self.content
+
+
+def test_fetch_screenshot_uses_cache_by_mode(cache, monkeypatch):
+    provider = CountingProvider(png_bytes())
+    monkeypatch.setattr(main, "screenshot_provider", provider)
+    link = "https://example.it/pagina"
+    assert main.fetch_screenshot(link) == provider.content
+    assert main.fetch_screenshot(link) == provider.content
+    assert provider.calls == 1
+    main.fetch_screenshot(link, "refresh")
+    main.fetch_screenshot(link, "bypass")
+    assert provider.calls == 3
+
+
+def test_fetch_screenshot_does_not_cache_non_images(cache, monkeypatch):
+    provider = CountingProvider(b"<html>errore</html>")
+    monkeypatch.setattr(main, "screenshot_provider", provider)
+    with pytest.raises(ValueError):
+        main.fetch_screenshot("https://example.it/rotto")
+    assert cache.stats()["stores"] == 0
+    provider.content = png_bytes()
+    assert main.fetch_screenshot("https://example.it/rotto") == provider.content
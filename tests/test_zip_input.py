@@ -0,0 +1,112 @@
+import asyncio
+import base64
+import io
+import zipfile
+from urllib.parse import urlencode
+
+import pytest
+from PIL import Image
+
+import main
+
+
+def decode(data: str, chunk_chars: int, monkeypatch) -> bytes:
+    monkeypatch.setattr(main, "BASE64_CHUNK_CHARS", chunk_chars)
+    target = io.BytesIO()
+    main.decode_base64_to_file(data, target)
+    return target.getvalue()
+
+
+@pytest.mark.parametrize("chunk_chars", [4, 5, 7, 8, 1024])
+def test_decode_base64_chunk_boundaries(chunk_chars, monkeypatch):
+    payload = bytes(range(256)) * 3 + b"fine"
+    encoded = base64.b64encode(payload).decode()
+    wrapped = "\n".join(encoded[i:i + 76] for i in range(0, len(encoded), 76))
+    assert decode(wrapped, chunk_chars, monkeypatch) == payload
+    assert decode(" \t" + encoded + "\r\n", chunk_chars, monkeypatch) == payload
+
+
+@pytest.mark.parametrize("chunk_chars", [4, 6, 1024])
+def test_decode_base64_ignores_non_alphabet_like_b64decode(chunk_chars, monkeypatch):
+    data = "aGVsb-G8gd29ybGQhIQ=="
+    assert decode(data, chunk_chars, monkeypatch) == base64.b64decode(data) == b"hello world!!"
+
+
+def test_decode_base64_missing_padding(monkeypatch):
+    assert decode("aGVsbG8", 4, monkeypatch) == b"hello"
+
+
+def zip_bytes() -> bytes:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        z.writestr("img.png", bytes(range(256)) * 64)
+    return buf.getvalue()
+
+
+def read_zip_input(body: bytes, content_type: str = "", chunk_size: int = 1000):
+    """Esegue main.read_zip_input su una richiesta ASGI con il body inviato a blocchi."""
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)] or [b""]
+    messages = [{"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1}
+                for i, chunk in enumerate(chunks)]
+
+    async def receive():
+        return messages.pop(0)
+
+    headers = [(b"content-type", content_type.encode())] if content_type else []
+    request = main.Request({"type": "http", "method": "POST", "path": "/", "headers": headers,
+                            "query_string": b""}, receive)
+
+    async def run():
+        zip_input = await main.read_zip_input(request)
+        content = zip_input.file.read() if zip_input.file is not None else None
+        rolled = getattr(zip_input.file, "_rolled", None)
+        await zip_input.close()
+        return zip_input, content, rolled
+
+    return asyncio.run(run())
+
+
+def test_raw_body_is_spooled_to_disk_over_the_threshold(monkeypatch):
+    monkeypatch.setattr(main, "UPLOAD_SPOOL_MEMORY", 4096)
+    data = zip_bytes()
+    zip_input, content, rolled = read_zip_input(data)
+    assert content == data and zip_input.size == len(data)
+    assert rolled
+
+
+def test_raw_body_that_is_not_a_zip_is_ignored():
+    zip_input, content, _ = read_zip_input(b"non e' uno zip")
+    assert zip_input.file is None and content is None
+
+
+def test_base64_form_field_is_decoded_to_a_spool():
+    data = zip_bytes()
+    encoded = base64.encodebytes(data).decode()
+    body = urlencode({"zip_data": encoded, "dpi": "150"}).encode()
+    zip_input, content, _ = read_zip_input(body, "application/x-www-form-urlencoded")
+    assert content == data and zip_input.fields["dpi"] == "150"
+
+
+def test_multipart_upload_uses_the_uploaded_file():
+    data = zip_bytes()
+    boundary = "confine"
+    body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"titolo\"\r\n\r\nReport\r\n"
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"immagini.zip\"\r\n"
+            f"Content-Type: application/zip\r\n\r\n").encode() + data + f"\r\n--{boundary}--\r\n".encode()
+    zip_input, content, _ = read_zip_input(body, f"multipart/form-data; boundary={boundary}")
+    assert content == data and zip_input.fields == {"titolo": "Report"}
+
+
+def test_pdf_is_rendered_from_a_zip_file_object(monkeypatch):
+    monkeypatch.setattr(main, "IMAGE_WORKERS", 1)
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        for i in range(2):
+            image = io.BytesIO()
+            Image.new("RGB", (80, 60), (i * 90, 40, 40)).save(image, "PNG")
+            z.writestr(f"img{i}.png", image.getvalue())
+    buf.seek(0)
+    output = io.BytesIO()
+    stats = {}
+    assert main.create_pdf_from_images(buf, main.RenderOptions(), stats, output=output) is None
+    assert output.getvalue().startswith(b"%PDF-") and stats["input_bytes"] == len(buf.getvalue())